@@ -1,8 +1,24 @@
+import time
+
 import bempp.api
 import numpy as np
+import scipy.linalg
+import scipy.sparse.linalg
+
+import profiling
+from profiling import log
+
+# meshes with more faces than this are assembled with fmm instead of dense matrices
+FMM_FACES = 20000
+
+# relative gmres tolerance of the session solves
+TOL = 1e-5
+
+# relative frequency distance over which a preconditioner is reused
+PRECOND_BANDWIDTH = 0.1
 
 def p_bar(object_mesh, sample_points, frequency, participation, c=343, rho_air=1.21):
-    print(f"Start Calculating p_bar for frequency {frequency}-------------------")
+    log.info(f"Start Calculating p_bar for frequency {frequency}-------------------")
     
     object_grids = bempp.api.Grid(object_mesh.vertices.T, object_mesh.faces.T)
     space = bempp.api.function_space(object_grids, "P", 1)
@@ -26,5 +42,154 @@ def p_bar(object_mesh, sample_points, frequency, participation, c=343, rho_air=1
     slp_potential = bempp.api.operators.potential.helmholtz.single_layer(space, sample_points, k)
     p_bar = slp_potential.evaluate(pressure_solution)
     
-    print("Finish Calculating p_bar -------------------")
-    return p_bar
\ No newline at end of file
+    log.info("Finish Calculating p_bar -------------------")
+    return p_bar
+
+
+def default_assembler(object_mesh):
+    # compressed (fmm) assembly for large meshes, dense otherwise
+    return "fmm" if len(object_mesh.faces) > FMM_FACES else "default_nonlocal"
+
+
+def axis_vibration(axis, scale):
+    # neumann data rho * omega^2 * n[axis], the unit participation along one axis
+    @bempp.api.complex_callable
+    def vibration(x, n, domain_index, result):
+        result[0] = scale * n[axis]
+    return vibration
+
+
+class BemSession:
+    '''BEM solves on one surface mesh, grid, space and identity are built once
+
+    the neumann data is linear in the participation vector, so every frequency
+    is solved for the three axis right-hand sides and p_bar of any mode at that
+    frequency is their linear combination
+
+    gmres is seeded with the solution of the nearest frequency solved so far,
+    which makes sweeps over many close frequencies cheap
+    '''
+    
+    def __init__(self, object_mesh, sample_points, c=343, rho_air=1.21, tol=TOL,
+                 assembler=None, warm_start=True, scale_guess=True,
+                 precondition=False, precond_bandwidth=PRECOND_BANDWIDTH):
+        self.grid = bempp.api.Grid(object_mesh.vertices.T, object_mesh.faces.T)
+        self.space = bempp.api.function_space(self.grid, "P", 1)
+        self.identity = bempp.api.operators.boundary.sparse.identity(self.space, self.space, self.space)
+        self.sample_points = sample_points
+        self.c = c
+        self.rho_air = rho_air
+        self.tol = tol
+        
+        # the potential operators only know "dense" and "fmm"
+        if assembler is None:
+            assembler = default_assembler(object_mesh)
+        self.assembler = assembler
+        self.potential_assembler = "fmm" if assembler == "fmm" else "dense"
+        
+        self.warm_start = warm_start
+        self.scale_guess = scale_guess
+        # an LU of the dense system at a nearby frequency, not available with fmm
+        self.precondition = precondition and assembler != "fmm"
+        self.precond_bandwidth = precond_bandwidth
+        self._preconditioner = None
+        
+        # frequency -> (3, N) p_bar for unit participation along x, y, z
+        self.axis_fields = {}
+        # frequency -> surface solution coefficients of each axis, used as initial guesses
+        self.solutions = {}
+        # frequency -> timing, gmres iterations and relative residual of each axis solve
+        self.stats = {}
+    
+    def _initial_guess(self, frequency):
+        if not self.warm_start or not self.solutions:
+            return [None] * 3
+        nearest = min(self.solutions, key=lambda f: abs(f - frequency))
+        # the right-hand side scales with omega^2
+        scale = (frequency / nearest)**2 if self.scale_guess else 1.0
+        return [scale * x for x in self.solutions[nearest]]
+    
+    def _get_preconditioner(self, frequency, lhs):
+        if self._preconditioner is not None:
+            ref_frequency, M = self._preconditioner
+            if abs(frequency - ref_frequency) <= self.precond_bandwidth * ref_frequency:
+                return M
+        
+        with profiling.stage("bem.precondition"):
+            lu = scipy.linalg.lu_factor(bempp.api.as_matrix(lhs.weak_form()))
+        M = scipy.sparse.linalg.LinearOperator(
+            lu[0].shape, matvec=lambda v: scipy.linalg.lu_solve(lu, v), dtype=np.complex128)
+        self._preconditioner = (frequency, M)
+        return M
+    
+    def _gmres(self, A, b, x0, M):
+        iteration_count = 0
+        def count(_):
+            nonlocal iteration_count
+            iteration_count += 1
+        
+        with profiling.stage("bem.gmres"):
+            x, _ = scipy.sparse.linalg.gmres(A, b, x0=x0, rtol=self.tol, M=M, callback=count, callback_type="pr_norm")
+        residual = np.linalg.norm(A @ x - b) / np.linalg.norm(b)
+        profiling.count("bem.gmres_iterations", iteration_count)
+        return x, iteration_count, residual
+    
+    @profiling.profiled("bem.solve")
+    def solve(self, frequency):
+        if frequency in self.axis_fields:
+            return self.axis_fields[frequency]
+        
+        log.info(f"Start Calculating axis fields for frequency {frequency}-------------------")
+        start_time = time.perf_counter()
+        
+        omega = 2 * np.pi * frequency
+        k = omega / self.c
+        
+        # operators are assembled on the first solve and reused for the other axes
+        slp = bempp.api.operators.boundary.helmholtz.single_layer(
+            self.space, self.space, self.space, k, assembler=self.assembler)
+        dlp = bempp.api.operators.boundary.helmholtz.double_layer(
+            self.space, self.space, self.space, k, assembler=self.assembler)
+        lhs = 0.5 * self.identity - dlp + 1j * k * slp
+        with profiling.stage("bem.assemble", frequency=frequency):
+            A = lhs.weak_form()
+            slp_potential = bempp.api.operators.potential.helmholtz.single_layer(
+                self.space, self.sample_points, k, assembler=self.potential_assembler)
+        M = self._get_preconditioner(frequency, lhs) if self.precondition else None
+        
+        fields = []
+        solutions = []
+        iterations = []
+        residuals = []
+        for axis, x0 in enumerate(self._initial_guess(frequency)):
+            rhs_fun = bempp.api.GridFunction(self.space, fun=axis_vibration(axis, self.rho_air * omega**2))
+            x, iteration_count, residual = self._gmres(A, rhs_fun.projections(self.space), x0, M)
+            
+            pressure_solution = bempp.api.GridFunction(self.space, coefficients=x)
+            with profiling.stage("bem.potential"):
+                fields.append(slp_potential.evaluate(pressure_solution)[0])
+            solutions.append(x)
+            iterations.append(iteration_count)
+            residuals.append(residual)
+        
+        self.axis_fields[frequency] = np.array(fields)
+        self.solutions[frequency] = solutions
+        self.stats[frequency] = {
+            "time": time.perf_counter() - start_time,
+            "iterations": iterations,
+            "residuals": residuals,
+        }
+        
+        log.info(f"Finish Calculating axis fields, gmres iterations {iterations} -------------------")
+        return self.axis_fields[frequency]
+    
+    def sweep(self, frequencies):
+        # ascending order so every solve starts from its nearest solved neighbour
+        for frequency in sorted(set(frequencies)):
+            self.solve(frequency)
+        return {frequency: self.stats[frequency] for frequency in frequencies}
+    
+    def p_bar(self, frequency, participation):
+        # same (1, N) layout as p_bar
+        fields = self.solve(frequency)
+        return (np.asarray(participation, dtype=np.float64) @ fields)[None, :]
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import trimesh
+
+from geometry import init_weight_mat, generate_candidate_points
+from multipole_algo import pick_multipole, expand_subspace_and_update_residual, ProjectedCandidates
+from multipole_util import multipole_basis_func, modified_gram_schmidt, compute_coefficient, OrthoBasis, apply_weight
+from evaluate import evaluate_dipoles, evaluate_pressures
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# a benchmark is slower than the baseline when its time exceeds baseline * THRESHOLD
+THRESHOLD = 1.25
+
+FREQUENCY = 440.0
+
+# icosphere subdivisions, thin shell sections and the S, C and listener counts per size
+SIZES = {
+    "quick": {"sphere": [2, 3], "shell": [32], "sources": [4, 16], "candidates": [64], "listeners": [256]},
+    "full": {"sphere": [2, 3, 4, 5], "shell": [32, 128], "sources": [4, 16, 64], "candidates": [256, 1024], "listeners": [256, 4096]},
+}
+
+def timeit(func, repeat=5, min_time=0.05):
+    # best of repeat runs, each run loops func until it takes at least min_time
+    func()
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or loops >= 1 << 16:
+            break
+        loops *= 2
+
+    best = elapsed / loops
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best
+
+def synthetic_meshes(sizes):
+    # closed spheres and a thin drum-like disk, the shape of our membrane
+    meshes = {}
+    for subdivisions in sizes["sphere"]:
+        mesh = trimesh.creation.icosphere(subdivisions=subdivisions, radius=0.1)
+        meshes[f"sphere{len(mesh.vertices)}"] = mesh
+    for sections in sizes["shell"]:
+        mesh = trimesh.creation.cylinder(radius=0.1, height=0.005, sections=sections)
+        meshes[f"shell{len(mesh.vertices)}"] = mesh
+    return meshes
+
+def random_sources(rng, S, radius=0.05):
+    return rng.uniform(-radius, radius, (S, 3))
+
+def run_benchmarks(sizes, seed=0, bem=True):
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    def record(name, seconds):
+        results[name] = seconds
+        print(f"{name:60s} {seconds * 1e3:10.3f} ms")
+
+    for mesh_name, mesh in synthetic_meshes(sizes).items():
+        record(f"init_weight_mat[{mesh_name}]", timeit(lambda: init_weight_mat(mesh)))
+        W, sample_points = init_weight_mat(mesh)
+        sample_points = np.asarray(sample_points)
+        N = len(sample_points)
+
+        for C in sizes["candidates"]:
+            record(f"generate_candidate_points[{mesh_name},C={C}]",
+                   timeit(lambda: generate_candidate_points(mesh, C, seed=seed), repeat=3))
+
+        residual = rng.normal(size=N) + 1j * rng.normal(size=N)
+        residual /= np.linalg.norm(residual)
+
+        for C in sizes["candidates"]:
+            candidates = random_sources(rng, C)
+            record(f"pick_multipole[{mesh_name},C={C}]",
+                   timeit(lambda: pick_multipole(residual, candidates, sample_points, W, multipole_basis_func, FREQUENCY), repeat=3))
+            projected = ProjectedCandidates(candidates, sample_points, W, multipole_basis_func, FREQUENCY, residual)
+            record(f"projected_candidates_scores[{mesh_name},C={C}]", timeit(projected.scores, repeat=3))
+            Q_new = np.linalg.qr(rng.normal(size=(N, 4)) + 0j)[0]
+            record(f"projected_candidates_update[{mesh_name},C={C}]", timeit(lambda: projected.update(Q_new, residual), repeat=3))
+
+        for S in sizes["sources"]:
+            sources = random_sources(rng, S)
+            record(f"multipole_basis_func[{mesh_name},S={S}]",
+                   timeit(lambda: multipole_basis_func(sources, sample_points, FREQUENCY)))
+            record(f"multipole_basis_func[{mesh_name},S={S},l_max=3]",
+                   timeit(lambda: multipole_basis_func(sources, sample_points, FREQUENCY, l_max=3)))
+
+            # basis of S sources already placed, then one more expansion
+            A = apply_weight(W, multipole_basis_func(sources, sample_points, FREQUENCY))
+            if 4 * S <= N:
+                record(f"modified_gram_schmidt[{mesh_name},S={S}]", timeit(lambda: modified_gram_schmidt(A), repeat=3))
+
+                # only the appended block is timed, the basis is rolled back to S sources each call
+                Q = OrthoBasis(N, 4 * S + 4)
+                Q.append(A)
+                def expand():
+                    Q.size = 4 * S
+                    expand_subspace_and_update_residual(Q, residual.copy(), sources[0] * 0.5, sample_points, W, multipole_basis_func, FREQUENCY)
+                record(f"expand_subspace_and_update_residual[{mesh_name},S={S}]", timeit(expand, repeat=3))
+
+                p_bar = A @ (rng.normal(size=4 * S) + 1j * rng.normal(size=4 * S))
+                record(f"compute_coefficient[{mesh_name},S={S}]",
+                       timeit(lambda: compute_coefficient(W, sources, p_bar, sample_points, FREQUENCY), repeat=3))
+
+    k = 2 * np.pi * FREQUENCY / 343
+    for S in sizes["sources"]:
+        sources = np.zeros((S, 11))
+        sources[:, :3] = random_sources(rng, S)
+        sources[:, 3:] = rng.normal(size=(S, 8))
+        record(f"evaluate_dipoles[S={S}]", timeit(lambda: evaluate_dipoles(np.array([0.0, 0.0, 1.0]), sources, k)))
+        for L in sizes["listeners"]:
+            listeners = rng.normal(size=(L, 3))
+            record(f"evaluate_pressures[S={S},L={L}]", timeit(lambda: evaluate_pressures(listeners, [(sources, k)])))
+
+    if bem:
+        run_bem_benchmarks(sizes, record)
+
+    return results
+
+def run_bem_benchmarks(sizes, record):
+    try:
+        from bem import BemSession
+    except ImportError:
+        print("bempp not installed, skipping BEM benchmarks")
+        return
+
+    for subdivisions in sizes["sphere"][:2]:
+        mesh = trimesh.creation.icosphere(subdivisions=subdivisions, radius=0.1)
+        sample_points = np.asarray(mesh.vertices).T
+
+        def solve():
+            BemSession(mesh, sample_points).solve(FREQUENCY)
+        record(f"bem_solve[sphere{len(mesh.vertices)}]", timeit(solve, repeat=1, min_time=0.0))
+
+def compare(results, baseline, threshold=THRESHOLD):
+    # names of the benchmarks slower than the baseline by more than threshold
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name]
+        if ratio > threshold:
+            regressions.append(name)
+            print(f"REGRESSION {name}: {baseline[name] * 1e3:.3f} ms -> {seconds * 1e3:.3f} ms ({ratio:.2f}x)")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the precompute and evaluation hot paths")
+    parser.add_argument("--size", choices=sorted(SIZES), default="quick")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--no-bem", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = run_benchmarks(SIZES[args.size], seed=args.seed, bem=not args.no_bem)
+    report = {
+        "size": args.size,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Wrote baseline {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("size") != args.size:
+            print(f"Baseline was recorded with --size {baseline.get('size')}, only matching names are compared")
+        if compare(results, baseline["results"], args.threshold):
+            sys.exit(1)
@@ -0,0 +1,106 @@
+import hashlib
+import os
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# total size of the cache directory before the least recently used entries are evicted
+MAX_BYTES = 4 << 30
+
+def hash_key(*arrays, **params):
+    # content hash of the arrays and named parameters an artifact depends on
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(f"{a.dtype.str}{a.shape}".encode())
+        h.update(a.tobytes())
+    for name in sorted(params):
+        value = np.ascontiguousarray(params[name])
+        h.update(f"{name}:{value.dtype.str}{value.shape}".encode())
+        h.update(value.tobytes())
+    return h.hexdigest()
+
+def mesh_key(mesh):
+    return hash_key(mesh.vertices, mesh.faces)
+
+def file_key(path, **params):
+    # content hash of a file and the parameters of what is derived from it
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return hash_key(np.frombuffer(h.digest(), dtype=np.uint8), **params)
+
+class ArtifactCache:
+    '''content-addressed store of compressed .npz artifacts with LRU eviction
+
+    entries are named <kind>-<key>.npz, reading an entry refreshes its mtime
+    so the oldest mtime is the least recently used
+    '''
+
+    def __init__(self, root=CACHE_DIR, max_bytes=MAX_BYTES, enabled=True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+    def _path(self, kind, key):
+        return os.path.join(self.root, f"{kind}-{key}.npz")
+
+    def _entries(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [entry for entry in os.scandir(self.root) if entry.name.endswith(".npz")]
+
+    def load(self, kind, key):
+        if not self.enabled:
+            return None
+        path = self._path(kind, key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        os.utime(path)
+        return arrays
+
+    def store(self, kind, key, **arrays):
+        if not self.enabled:
+            return
+        os.makedirs(self.root, exist_ok=True)
+
+        # write next to the final name and rename, a crash never leaves a partial entry
+        path = self._path(kind, key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in self._entries():
+            try:
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            total -= size
+            _remove(path)
+
+    def clear(self):
+        for entry in self._entries():
+            _remove(entry.path)
+
+def _remove(path):
+    # another process may have evicted the same entry
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,128 @@
+import numpy as np
+
+import profiling
+from multipole_util import multipole_pressure
+from profiling import log
+
+# default grid, theta includes both poles and phi wraps around
+NUM_THETA = 33
+NUM_PHI = 64
+NUM_RADII = 5
+
+def grid_directions(num_theta, num_phi):
+    # unit vectors of the (theta, phi) grid, shape (num_theta, num_phi, 3)
+    theta = np.linspace(0, np.pi, num_theta)
+    phi = np.linspace(0, 2 * np.pi, num_phi, endpoint=False)
+    sin_theta = np.sin(theta)[:, None]
+    return np.stack((
+        sin_theta * np.cos(phi)[None, :],
+        sin_theta * np.sin(phi)[None, :],
+        np.repeat(np.cos(theta)[:, None], num_phi, axis=1),
+    ), axis=-1)
+
+def default_radii(positions, center, k, num_radii=NUM_RADII):
+    # shells from just outside the sources out to the far field of the mode
+    extent = max(np.max(np.linalg.norm(positions - center, axis=1), initial=0.0), 1e-3)
+    return np.geomspace(2 * extent, max(32 * extent, 10 / k), num_radii)
+
+def sample_table(positions, coefficients, k, center, radii, num_theta, num_phi):
+    # |p| r on every shell, r |p| tends to the far-field directivity as r grows
+    directions = grid_directions(num_theta, num_phi).reshape(-1, 3)
+    magnitudes = np.empty((len(radii), num_theta, num_phi), dtype=np.float32)
+    for i, radius in enumerate(radii):
+        p = multipole_pressure(center + radius * directions, positions, coefficients, k)
+        magnitudes[i] = (radius * np.abs(p)).reshape(num_theta, num_phi)
+    return magnitudes
+
+def query_directivity(table, listeners):
+    '''pressure magnitude at the listeners from a baked table
+
+    bilinear in (theta, phi), linear in 1 / r between shells and 1 / r decay
+    outside of them, listeners closer than the innermost shell use its value
+    '''
+    listeners = np.asarray(listeners, dtype=np.float64).reshape(-1, 3)
+    magnitudes = np.asarray(table["magnitudes"])
+    radii = np.asarray(table["radii"])
+    num_radii, num_theta, num_phi = magnitudes.shape
+
+    d = listeners - np.asarray(table["center"])
+    r = np.maximum(np.linalg.norm(d, axis=1), 1e-10)
+    theta = np.arccos(np.clip(d[:, 2] / r, -1.0, 1.0))
+    phi = np.mod(np.arctan2(d[:, 1], d[:, 0]), 2 * np.pi)
+
+    # fractional grid coordinates
+    t = theta / np.pi * (num_theta - 1)
+    t0 = np.minimum(t.astype(np.intp), num_theta - 2)
+    wt = t - t0
+    f = phi / (2 * np.pi) * num_phi
+    f0 = f.astype(np.intp) % num_phi
+    f1 = (f0 + 1) % num_phi
+    wf = f - np.floor(f)
+
+    # (num_radii, L) interpolated |p| r on every shell
+    shells = (
+        (1 - wt) * ((1 - wf) * magnitudes[:, t0, f0] + wf * magnitudes[:, t0, f1])
+        + wt * ((1 - wf) * magnitudes[:, t0 + 1, f0] + wf * magnitudes[:, t0 + 1, f1])
+    )
+
+    # radii grow so 1 / r shrinks, interpolate in 1 / r clamped to the outer shells
+    inv_r = 1.0 / np.clip(r, radii[0], radii[-1])
+    inv_radii = 1.0 / radii
+    if num_radii == 1:
+        pr = shells[0]
+    else:
+        s = np.clip(np.searchsorted(-inv_radii, -inv_r) - 1, 0, num_radii - 2)
+        w = (inv_radii[s] - inv_r) / (inv_radii[s] - inv_radii[s + 1])
+        columns = np.arange(len(listeners))
+        pr = (1 - w) * shells[s, columns] + w * shells[s + 1, columns]
+
+    return pr / np.maximum(r, radii[0])
+
+def validation_error(table, positions, coefficients, k, num_points=512, seed=0):
+    # max error against the exact evaluator, relative to the largest pressure on the same shell
+    rng = np.random.default_rng(seed)
+    radii = np.asarray(table["radii"])
+    # the shells, their midpoints in 1 / r and twice the outermost one
+    inv_radii = 1.0 / radii
+    test_radii = np.concatenate((radii, 2.0 / (inv_radii[:-1] + inv_radii[1:]), [2 * radii[-1]]))
+
+    error = 0.0
+    for radius in test_radii:
+        directions = rng.normal(size=(num_points, 3))
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        listeners = np.asarray(table["center"]) + radius * directions
+        exact = np.abs(multipole_pressure(listeners, positions, coefficients, k))
+        approx = query_directivity(table, listeners)
+        error = max(error, np.max(np.abs(approx - exact)) / max(np.max(exact), 1e-30))
+    return error
+
+@profiling.profiled("export.directivity")
+def bake_directivity(positions, coefficients, k, num_theta=NUM_THETA, num_phi=NUM_PHI, radii=None,
+                     num_radii=NUM_RADII, tolerance=None, max_refinements=3):
+    '''sample a mode on an angular grid and a few radial shells around its sources
+
+    with a tolerance the grid is refined, angles and default shells are doubled,
+    until the validation error against the exact evaluator is below it or
+    max_refinements is reached, the measured error is stored in the table
+    '''
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    coefficients = np.asarray(coefficients, dtype=np.complex128)
+    center = positions.mean(axis=0)
+
+    for refinement in range(max_refinements + 1):
+        shells = default_radii(positions, center, k, num_radii) if radii is None else np.sort(np.asarray(radii, dtype=np.float64))
+        table = {
+            "center": center,
+            "radii": shells,
+            "magnitudes": sample_table(positions, coefficients, k, center, shells, num_theta, num_phi),
+        }
+        table["max_error"] = validation_error(table, positions, coefficients, k)
+        if tolerance is None or table["max_error"] <= tolerance:
+            break
+        num_theta = 2 * num_theta - 1
+        num_phi = 2 * num_phi
+        num_radii = 2 * num_radii - 1
+
+    if tolerance is not None and table["max_error"] > tolerance:
+        log.warning(f"Directivity error {table['max_error']:.3g} above tolerance {tolerance} after {max_refinements} refinements")
+    return table
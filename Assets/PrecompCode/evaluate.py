@@ -1,7 +1,14 @@
 import numpy as np
 import struct
+import sys
+import wave
 import scipy.special as sp
-import scipy.io.wavfile as wavfile
+from multipole_util import multipole_pressures, num_terms
+from pat_bundle import load_bundle, read_k_file
+from synth import ModalSynth
+from directivity import query_directivity
+
+SPEED_OF_SOUND = 343
 
 def spherical_coords(rel_pos):
     x, y, z = rel_pos
@@ -10,79 +17,68 @@ def spherical_coords(rel_pos):
     phi = np.arctan2(y, x)
     return r, theta, phi, x, y, z
 
-def complex_mul(aRe, aIm, bRe, bIm):
-    oRe = (aRe) * (bRe) - (aIm) * (bIm)
-    oIm = (aRe) * (bIm) + (aIm) * (bRe)
-    return oRe, oIm
-
-def complex_fma(aRe, aIm, bRe, bIm, oRe, oIm):
-    oRe += (aRe) * (bRe) - (aIm) * (bIm)
-    oIm += (aRe) * (bIm) + (aIm) * (bRe)
-    return oRe, oIm
+def split_sources(sources):
+    # rows of (x, y, z, Re, Im, ...) -> (S, 3) positions and (T * S,) complex coefficients
+    sources = np.asarray(sources, dtype=np.float64).reshape(len(sources), -1)
+    positions = sources[:, :3]
+    coefficients = (sources[:, 3::2] + 1j * sources[:, 4::2]).ravel()
+    return positions, coefficients
+
+# input: listeners: positions of the listeners, shape (L, 3)
+#        modes: sequence of (sources, k), sources as loaded by load_sources
+#        dtype: np.float32 evaluates in single precision
+# ouput: pressures: pressure magnitude of every mode at every listener, shape (L, modes)
+def evaluate_pressures(listeners, modes, dtype=np.float64):
+    return evaluate_modes(listeners, [(*split_sources(sources), k) for sources, k in modes], dtype)
+
+# same as evaluate_pressures with modes as (positions, coefficients, k), as stored in a bundle,
+# modes with the same positions and order share the listener to source geometry,
+# groups from group_modes can be passed in when the same modes are evaluated repeatedly
+def evaluate_modes(listeners, modes, dtype=np.float64, groups=None):
+    listeners = np.asarray(listeners, dtype=np.float64).reshape(-1, 3)
+    pressures = np.empty((len(listeners), len(modes)), dtype=dtype)
+
+    for indices in group_modes(modes) if groups is None else groups:
+        positions = modes[indices[0]][0]
+        p = multipole_pressures(
+            listeners, positions,
+            [modes[j][1] for j in indices], [modes[j][2] for j in indices], dtype=dtype
+        )
+        pressures[:, indices] = np.abs(p)
+
+    return pressures
+
+def group_modes(modes):
+    # indices of the modes grouped by identical positions and coefficient count
+    groups = {}
+    for j, (positions, coefficients, k) in enumerate(modes):
+        key = (np.ascontiguousarray(positions, dtype=np.float64).tobytes(), np.size(coefficients))
+        groups.setdefault(key, []).append(j)
+    return list(groups.values())
+
+# pressure magnitudes from baked directivity tables, one lookup per listener and mode
+def evaluate_tables(listeners, tables):
+    listeners = np.asarray(listeners, dtype=np.float64).reshape(-1, 3)
+    return np.stack([query_directivity(table, listeners) for table in tables], axis=1)
+
+def load_bundle_modes(filename):
+    # (positions, coefficients, k) of every mode in a bundle, backed by one memory mapping
+    return [(mode["positions"], mode["coefficients"], mode["k"]) for mode in load_bundle(filename)]
 
 # input: mic_pos: position of the microphone (numpy array)
-#        sources: array of sources, each source is a numpy array of shape (11,)
+#        sources: array of sources, each source is a numpy array of shape (3 + 2T,), T = (l_max + 1)^2
 #        k: wavenumber
 # ouput: pressure: the evaluated pressure at the microphone position
 def evaluate_dipoles(mic_pos, sources, k):
-    pressure_re, pressure_im = 0.0, 0.0
-
-    for source in sources:
-        src_pos = source[:3]
-        rel_pos = mic_pos - src_pos
-        x,y,z = rel_pos
-        r = np.linalg.norm(rel_pos)
-        planar_r = np.sqrt(x**2 + y**2)
-        if r == 0 or planar_r == 0:
-            continue
-        
-        cos_theta = z / np.sqrt(x**2 + y**2 + z**2)
-        sin_theta = planar_r / np.linalg.norm([x, y, z])
-        cos_phi = x / planar_r if planar_r > 0 else 0.0
-        sin_phi = y / planar_r if planar_r > 0 else 0.0
-        
-        kr = k * r
-        invKr = 1.0 / kr if kr != 0 else 0.0
-        sin_kr, cos_kr = np.sin(kr), np.cos(kr)
-
-        cos_phi_sin_theta = cos_phi * sin_theta
-        sin_phi_sin_theta = sin_phi * sin_theta
-
-        mono_re, mono_im = source[3], source[4]
-        dip0_re, dip0_im = source[5], source[6]
-        dip_m1_re, dip_m1_im = source[7], source[8]
-        dip_p1_re, dip_p1_im = source[9], source[10]
-
-        # monopole contribution
-        bufferRe = sin_kr * invKr
-        bufferIm = cos_kr * invKr
-        pressure_re, pressure_im = complex_fma(bufferRe, bufferIm, mono_re, mono_im, pressure_re, pressure_im)
-
-        # dipole m=0 contribution
-        radial_re = invKr * (-cos_kr + invKr * sin_kr)
-        radial_im = invKr * (sin_kr + invKr * cos_kr)
-        
-        bufferRe = radial_re * cos_theta
-        bufferIm = radial_im * cos_theta
-        pressure_re, pressure_im = complex_fma(bufferRe, bufferIm, dip0_re, dip0_im, pressure_re, pressure_im)
-        
-        # dipole m=-1 contribution
-        bufferRe, bufferIm = complex_mul(radial_re, radial_im, cos_phi_sin_theta, -sin_phi_sin_theta)
-        pressure_re, pressure_im = complex_fma(bufferRe, bufferIm, dip_m1_re, dip_m1_im, pressure_re, pressure_im)
-
-        # dipole (m=+1)
-        bufferRe, bufferIm = complex_mul(radial_re, radial_im, -cos_phi_sin_theta, -sin_phi_sin_theta)
-        pressure_re, pressure_im = complex_fma(bufferRe, bufferIm, dip_p1_re, dip_p1_im, pressure_re, pressure_im)
-
-    return np.abs(pressure_re + 1j * pressure_im)
+    return evaluate_pressures(mic_pos, [(sources, k)])[0, 0]
 
 # Example usage:
-def load_sources(filename):
-    with open(filename, 'rb') as f:
-        data = f.read()
-        num_sources = len(data) // (11 * 8)
-        sources = struct.unpack(f'{num_sources * 11}d', data)
-    return np.array(sources).reshape(num_sources, 11)
+def load_sources(filename, l_max=1):
+    return np.fromfile(filename, dtype=np.float64).reshape(-1, 3 + 2 * num_terms(l_max))
+
+def load_order(filename):
+    # multipole order stored in a .k file
+    return read_k_file(filename)[1]
 
 def load_k(filename):
     with open(filename, 'rb') as f:
@@ -105,25 +101,38 @@ if __name__ == '__main__':
     
     duration = 2.0  # Audio duration (seconds)
     sample_rate = 44100  # Standard audio sampling rate
-    
-    # Load example data and evaluate pressures
-    with open("PATlist.txt") as f:
-        pat_list = f.read().splitlines()
+    damping = 3.0  # Decay rate of every mode (1/s)
     
     mic_positions = np.array([0.0, 0.0, 1.0])  # Example microphone positions
     
-    frequencies = []
-    pressures = []
-    for idx, pat in enumerate(pat_list):
-        print(f"Processing PAT: {pat}")    
-        sources = load_sources(f"{pat}.sources")
-        k = load_k(f"{pat}.k")
-        frequencies.append(k * (343 / (2 * np.pi)))  # Assuming speed of sound is 343 m/s
-        pressures.append(evaluate_dipoles(mic_positions, sources, k))
+    # Load example data and evaluate pressures, from a bundle or the per-mode files of a PATlist
+    data_file = sys.argv[1] if len(sys.argv) > 1 else "PATlist.txt"
+    if data_file.endswith(".pat"):
+        modes = load_bundle_modes(data_file)
+        pressures = evaluate_modes(mic_positions, modes)[0]
+    else:
+        with open(data_file) as f:
+            pat_list = f.read().splitlines()
+        
+        modes = []
+        for idx, pat in enumerate(pat_list):
+            print(f"Processing PAT: {pat}")    
+            modes.append((load_sources(f"{pat}.sources", load_order(f"{pat}.k")), load_k(f"{pat}.k")))
+        pressures = evaluate_pressures(mic_positions, modes)[0]
+    
+    frequencies = [mode[-1] * (SPEED_OF_SOUND / (2 * np.pi)) for mode in modes]
     
-
     print("Pressure magnitudes:", pressures)
-    t = np.linspace(0, duration, int(sample_rate * duration), endpoint=False)
     
-    waveform = pressure_to_waveform(pressures, frequencies, duration, sample_rate)
-    wavfile.write("pat_sound.wav", sample_rate, np.int16(waveform * 32767))
\ No newline at end of file
+    # one strike at t = 0, the pressures are the per-mode gains at the listener,
+    # scaled so that the summed modes cannot clip before the limiter
+    synth = ModalSynth(frequencies, damping=damping, sample_rate=sample_rate, gains=pressures / np.sum(pressures))
+    synth.strike()
+    
+    num_blocks = int(np.ceil(duration * sample_rate / synth.block_size))
+    with wave.open("pat_sound.wav", "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        for block in synth.blocks(num_blocks):
+            f.writeframes(np.int16(block * 32767).tobytes())
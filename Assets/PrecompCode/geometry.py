@@ -1,6 +1,16 @@
 import numpy as np
+import scipy.ndimage
 import trimesh
 
+import profiling
+from cache import file_key
+from profiling import log
+
+# upper bound on bounding box samples tested for containment in one round,
+# they are tested CONTAINS_CHUNK at a time
+MAX_DRAW = 1 << 16
+
+@profiling.profiled("mesh.load")
 def load_mesh(membrane_path, surface_path):
     membrane = trimesh.load(membrane_path, process=True)
     surface = trimesh.load(surface_path, process=True)
@@ -19,41 +29,218 @@ def offset(original_mesh, offset_mesh):
     max_distance = np.max(distances)
     min_distance = np.min(distances)
 
-    print(f"Average offset distance: {avg_distance:.4f} m")
-    print(f"Max offset distance: {max_distance:.4f} m")
-    print(f"Min offset distance: {min_distance:.4f} m")
+    log.info(f"Average offset distance: {avg_distance:.4f} m")
+    log.info(f"Max offset distance: {max_distance:.4f} m")
+    log.info(f"Min offset distance: {min_distance:.4f} m")
     
     edge_lengths = original_mesh.edges_unique_length
     max_edge_length = np.max(edge_lengths)
     min_edge_length = np.min(edge_lengths)
-    print(f"Max edge length: {max_edge_length:.4f} m")
-    print(f"Min edge length: {min_edge_length:.4f} m")
+    log.info(f"Max edge length: {max_edge_length:.4f} m")
+    log.info(f"Min edge length: {min_edge_length:.4f} m")
 
-def init_weight_mat(mesh):
-    num_vertices = len(mesh.vertices)
-    
-    # get area of faces
-    face_area = mesh.area_faces
-    
-    vertex_weight = np.zeros(num_vertices)
-    for idx, face in enumerate(mesh.faces):
-        for v_id in face:
-            vertex_weight[v_id] += face_area[idx] / 3.0
+@profiling.profiled("mesh.weights")
+def vertex_areas(mesh):
+    # every face gives a third of its area to each of its vertices
+    faces = np.asarray(mesh.faces)
+    return np.bincount(
+        faces.ravel(),
+        weights=np.repeat(np.asarray(mesh.area_faces) / 3.0, faces.shape[1]),
+        minlength=len(mesh.vertices)
+    )
+
+def init_weight_mat(mesh, dense=False):
+    # vertex areas, precomputed by MeshArtifacts
+    vertex_weight = mesh.vertex_weights if isinstance(mesh, MeshArtifacts) else vertex_areas(mesh)
     
     # sample size N equal to number of vertices
-    # W is a diagonal matrix with diagonal elements equal to sqrt(vertex_weight)
-    W = np.diag(np.sqrt(vertex_weight))
+    # W is diagonal with diagonal elements equal to sqrt(vertex_weight), kept as
+    # the (N,) vector of its diagonal unless the dense matrix is requested
+    W = np.sqrt(vertex_weight)
+    if dense:
+        W = np.diag(W)
     return W, mesh.vertices
 
-def generate_candidate_points(mesh, num_points):
-    # create bounding box and sample points
+@profiling.profiled("candidates.generate")
+def generate_candidate_points(mesh, num_points, seed=None, max_rounds=20):
+    # uniform points inside the mesh, the bounding box is oversampled by the
+    # observed acceptance rate until num_points interior points are found
+    rng = np.random.default_rng(seed)
     min_bounds, max_bounds = mesh.bounds
-    candidate_points = np.random.uniform(min_bounds, max_bounds, (num_points, 3))
     
-    # check if candidate points are inside the mesh
     insides = []
-    for point in candidate_points:
-        if mesh.contains([point])[0]:  # Check if inside
-            insides.append(point)
+    num_inside, num_drawn = 0, 0
+    
+    for _ in range(max_rounds):
+        missing = num_points - num_inside
+        if missing <= 0:
+            break
+        
+        # thin shells reject most samples, draw more when nothing was accepted yet
+        accept_rate = num_inside / num_drawn if num_inside > 0 else 1.0 / (1 + num_drawn)
+        num_draw = min(int(np.ceil(1.2 * missing / accept_rate)) + 16, MAX_DRAW)
+        
+        candidate_points = rng.uniform(min_bounds, max_bounds, (num_draw, 3))
+        inside = candidate_points[contains_chunked(mesh, candidate_points)]
+        
+        insides.append(inside)
+        num_inside += len(inside)
+        num_drawn += num_draw
+    
+    if num_inside < num_points:
+        raise RuntimeError(f"only {num_inside} of {num_points} candidate points found inside the mesh")
+    
+    return np.concatenate(insides)[:num_points]
+
+class CandidatePool:
+    '''candidate points inside a mesh, shared across greedy iterations and modes'''
+    
+    def __init__(self, mesh, num_points, seed=None):
+        self.mesh = mesh
+        self.num_points = num_points
+        self.rng = np.random.default_rng(seed)
+        self.points = generate_candidate_points(mesh, num_points, self.rng)
     
-    return np.array(insides)
+    def refresh(self, fraction=1.0):
+        # redraw a random fraction of the pool in place, 1.0 gives a fresh pool
+        num_new = int(round(fraction * self.num_points))
+        if num_new > 0:
+            idx = self.rng.choice(self.num_points, num_new, replace=False)
+            self.points[idx] = generate_candidate_points(self.mesh, num_new, self.rng)
+        return self.points
+
+# cells of the containment grid along the longest side of the bounding box
+VOXEL_RESOLUTION = 64
+
+# containment grid cell states, boundary cells fall back to the exact test
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+# bumped whenever the stored arrays change
+MESH_ARTIFACTS_VERSION = 1
+
+# cell centers tested per connected region of the containment grid
+REGION_VOTES = 16
+
+# points per exact containment query, the ray tests need memory per point
+CONTAINS_CHUNK = 1 << 8
+
+def contains_chunked(mesh, points):
+    inside = np.empty(len(points), dtype=bool)
+    for start in range(0, len(points), CONTAINS_CHUNK):
+        inside[start:start + CONTAINS_CHUNK] = mesh.contains(points[start:start + CONTAINS_CHUNK])
+    return inside
+
+class MeshArtifacts:
+    '''processed mesh arrays and a voxel containment grid, stored in one cache entry
+
+    has the vertices, faces, area_faces, bounds and contains of a trimesh mesh so it
+    can be used by init_weight_mat, CandidatePool and BemSession, the trimesh mesh
+    itself is only rebuilt when an exact containment test or the diagnostics need it
+    '''
+
+    def __init__(self, vertices, faces, face_areas, face_normals, vertex_weights, grid, grid_origin, pitch):
+        self.vertices = vertices
+        self.faces = faces
+        self.area_faces = face_areas
+        self.face_normals = face_normals
+        self.vertex_weights = vertex_weights
+        self.grid = grid
+        self.grid_origin = grid_origin
+        self.pitch = float(pitch)
+        self._mesh = None
+
+    @classmethod
+    def from_mesh(cls, mesh, resolution=VOXEL_RESOLUTION):
+        bounds = mesh.bounds
+        pitch = np.max(bounds[1] - bounds[0]) / resolution
+        # one cell of padding, points outside the grid are outside the mesh
+        origin = bounds[0] - pitch
+        shape = tuple(np.floor((bounds[1] - origin) / pitch).astype(int) + 2)
+
+        # cells touched by the surface, its edges are subdivided below one cell
+        # so every cell a triangle passes through is next to a touched one
+        surface_points, _ = trimesh.remesh.subdivide_to_size(mesh.vertices, mesh.faces, max_edge=pitch, max_iter=32)
+        touched = np.zeros(shape, dtype=bool)
+        touched[tuple(np.floor((surface_points - origin) / pitch).astype(int).T)] = True
+        boundary = scipy.ndimage.binary_dilation(touched, structure=np.ones((3, 3, 3), dtype=bool))
+
+        # connected regions of the other cells are entirely inside or outside,
+        # a majority vote of a few cell centers per region decides
+        labels, num_regions = scipy.ndimage.label(~boundary)
+        cells = np.argwhere(~boundary)
+        region = labels[tuple(cells.T)]
+        order = np.argsort(region, kind="stable")
+        starts = np.searchsorted(region[order], np.arange(1, num_regions + 1))
+        rank = np.arange(len(order)) - starts[region[order] - 1]
+        voters = order[rank < REGION_VOTES]
+        inside = contains_chunked(mesh, origin + (cells[voters] + 0.5) * pitch)
+        votes = np.bincount(region[voters], weights=inside, minlength=num_regions + 1)
+        voter_counts = np.bincount(region[voters], minlength=num_regions + 1)
+
+        grid = np.full(shape, BOUNDARY, dtype=np.uint8)
+        grid[tuple(cells.T)] = np.where(2 * votes[region] > voter_counts[region], INSIDE, OUTSIDE)
+
+        artifacts = cls(
+            vertices=np.asarray(mesh.vertices, dtype=np.float64),
+            faces=np.asarray(mesh.faces),
+            face_areas=np.asarray(mesh.area_faces),
+            face_normals=np.asarray(mesh.face_normals),
+            vertex_weights=vertex_areas(mesh),
+            grid=grid,
+            grid_origin=origin,
+            pitch=pitch,
+        )
+        artifacts._mesh = mesh
+        return artifacts
+
+    def arrays(self):
+        return {
+            "vertices": self.vertices,
+            "faces": self.faces,
+            "face_areas": self.area_faces,
+            "face_normals": self.face_normals,
+            "vertex_weights": self.vertex_weights,
+            "grid": self.grid,
+            "grid_origin": self.grid_origin,
+            "pitch": np.float64(self.pitch),
+        }
+
+    @property
+    def bounds(self):
+        return np.array([self.vertices.min(axis=0), self.vertices.max(axis=0)])
+
+    @property
+    def mesh(self):
+        # the trimesh mesh, already processed when it was stored
+        if self._mesh is None:
+            self._mesh = trimesh.Trimesh(self.vertices, self.faces, face_normals=self.face_normals, process=False)
+        return self._mesh
+
+    def contains(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        cells = np.floor((points - self.grid_origin) / self.pitch).astype(np.intp)
+        in_grid = np.all((cells >= 0) & (cells < self.grid.shape), axis=1)
+
+        state = np.full(len(points), OUTSIDE, dtype=np.uint8)
+        state[in_grid] = self.grid[tuple(cells[in_grid].T)]
+        inside = state == INSIDE
+        boundary = state == BOUNDARY
+        if boundary.any():
+            inside[boundary] = contains_chunked(self.mesh, points[boundary])
+        return inside
+
+def load_mesh_artifacts(path, cache, resolution=VOXEL_RESOLUTION):
+    # processed mesh of an OBJ file, loaded from the cache unless the file changed
+    key = file_key(path, resolution=resolution, version=MESH_ARTIFACTS_VERSION)
+    cached = cache.load("mesh", key)
+    if cached is not None:
+        return MeshArtifacts(**cached)
+
+    artifacts = MeshArtifacts.from_mesh(trimesh.load(path, process=True), resolution)
+    cache.store("mesh", key, **artifacts.arrays())
+    return artifacts
+
+@profiling.profiled("mesh.load")
+def load_mesh_cached(membrane_path, surface_path, cache, resolution=VOXEL_RESOLUTION):
+    # same as load_mesh, with MeshArtifacts instead of trimesh meshes
+    return load_mesh_artifacts(membrane_path, cache, resolution), load_mesh_artifacts(surface_path, cache, resolution)
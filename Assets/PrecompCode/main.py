@@ -1,10 +1,17 @@
-from geometry import load_mesh, offset, init_weight_mat
-from bem import p_bar
-from multipole_algo import multipole_placement
-from multipole_util import multipole_basis_func
-from multipole_util import compute_coefficient
+from geometry import load_mesh_cached, offset, init_weight_mat, CandidatePool
+from bem import BemSession, TOL, default_assembler
+from multipole_algo import multipole_placement, joint_multipole_placement
+from multipole_util import multipole_basis_func, num_terms, L_MAX
+from multipole_util import compute_coefficient, apply_weight, leverage_scores, sketch_rows, weighted_residual, SKETCH_OVERSAMPLE
+from cache import ArtifactCache, CACHE_DIR, hash_key, mesh_key
+from pat_bundle import read_legacy_mode, write_bundle, DIRECTIVITY_TOLERANCE
+from directivity import bake_directivity
+from profiling import log
+import profiling
+import argparse
+import functools
+import os
 import struct
-import sys
 
 import numpy as np
 
@@ -39,11 +46,87 @@ modal_data_plastic = [
 ]
 
 
-def print_usage():
-    print("Usage: python main.py <source_number> <candidates_number>")
-    sys.exit(1) # Exit with an error code
+def parse_args():
+    parser = argparse.ArgumentParser(description="Precompute multipole sources of every mode")
+    parser.add_argument("source_number", type=int)
+    parser.add_argument("candidates_number", type=int)
+    parser.add_argument("seed", type=int, nargs="?", default=None)
+    parser.add_argument("--l-max", type=int, default=L_MAX, help="multipole order of every source")
+    parser.add_argument("--fixed-pool", action="store_true", help="evaluate the candidate bases once and update them incrementally")
+    parser.add_argument("--joint", action="store_true", help="place one set of sources shared by every mode")
+    parser.add_argument("--sketch", choices=["area", "leverage"], default=None, help="fit on a random sketch of the sample points")
+    parser.add_argument("--sketch-oversample", type=int, default=SKETCH_OVERSAMPLE, help="sketch rows per multipole term and source")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--no-cache", action="store_true", help="neither read nor write cached artifacts")
+    parser.add_argument("--clear-cache", action="store_true", help="remove all cached artifacts first")
+    parser.add_argument("--diagnostics", action="store_true", help="report offset distances and edge lengths of the meshes")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--trace", default=None, help="write stage timings, counters and residuals as a chrome trace")
+    return parser.parse_args()
 
-def export_sound_data(frequency, positions, coefficients, output_dir="output"):
+def load_weights(surface, cache):
+    # sqrt vertex weights and sample points of the surface mesh
+    key = mesh_key(surface)
+    cached = cache.load("weights", key)
+    if cached is not None:
+        return cached["W"], cached["sample_points"]
+    
+    W, sample_points = init_weight_mat(surface)
+    sample_points = np.asarray(sample_points)
+    cache.store("weights", key, W=W, sample_points=sample_points)
+    return W, sample_points
+
+def compute_p_bars(surface, sample_points, modes, cache, tol=TOL, assembler=None):
+    # p_bar of every mode, only the frequencies missing from the cache are solved,
+    # the solve parameters are part of the key since p_bar depends on them
+    if assembler is None:
+        assembler = default_assembler(surface)
+    keys = [
+        hash_key(
+            surface.vertices, surface.faces, sample_points,
+            frequency=mode["frequency"], participation=mode["participation"],
+            c=speed_of_sound, rho=rho_air, tol=tol, assembler=assembler
+        )
+        for mode in modes
+    ]
+    
+    p_bars = [None] * len(modes)
+    for i, key in enumerate(keys):
+        cached = cache.load("p_bar", key)
+        if cached is not None:
+            p_bars[i] = cached["p_bar"]
+    
+    missing = [i for i in range(len(modes)) if p_bars[i] is None]
+    if not missing:
+        return p_bars
+    
+    # bem solver, produce sound pressure evaluation on vertices of membrane
+    # grid, space and per-frequency operators are shared by all modes
+    bem_session = BemSession(surface, sample_points.T, c=speed_of_sound, rho_air=rho_air, tol=tol, assembler=assembler)
+    
+    # solve all frequencies up front as one warm-started sweep
+    sweep_stats = bem_session.sweep([modes[i]["frequency"] for i in missing])
+    for frequency, stats in sweep_stats.items():
+        log.info(f"{frequency}: {stats['time']:.2f} s, iterations {stats['iterations']}, residuals {stats['residuals']}")
+    
+    for i in missing:
+        p_bars[i] = bem_session.p_bar(
+            frequency=modes[i]["frequency"],
+            participation=modes[i]["participation"]
+            )
+        cache.store("p_bar", keys[i], p_bar=p_bars[i])
+    
+    return p_bars
+
+def output_base(frequency, output_dir):
+    return f"{output_dir}/{frequency:.0f}"
+
+def output_filenames(frequency, output_dir):
+    base = output_base(frequency, output_dir)
+    return f"{base}.sources", f"{base}.k"
+
+@profiling.profiled("export.sources")
+def export_sound_data(frequency, positions, coefficients, output_dir="output", l_max=L_MAX):
     # Export sound data to a file or any other format
     k = 2 * np.pi * frequency / speed_of_sound
     coefficients = np.array(coefficients.flatten(), dtype=np.complex128)
@@ -51,101 +134,247 @@ def export_sound_data(frequency, positions, coefficients, output_dir="output"):
     
     num_sources = len(positions)
     
-    sources_filename = f"{output_dir}/{frequency:.0f}.sources"
-    k_filename = f"{output_dir}/{frequency:.0f}.k"
-    
-    sources_data = []
-    for i in range(num_sources):
-        sources_data.extend(positions[i].tolist())
-        
-        # Monopole term (Re, Im)
-        sources_data.append(coefficients[4 * i].real)
-        sources_data.append(coefficients[4 * i].imag)
-
-        # Dipole (m=0) term (Re, Im)
-        sources_data.append(coefficients[4 * i + 1].real)
-        sources_data.append(coefficients[4 * i + 1].imag)
-
-        # Dipole (m=-1) term (Re, Im)
-        sources_data.append(coefficients[4 * i + 2].real)
-        sources_data.append(coefficients[4 * i + 2].imag)
-
-        # Dipole (m=+1) term (Re, Im)
-        sources_data.append(coefficients[4 * i + 3].real)
-        sources_data.append(coefficients[4 * i + 3].imag)
+    sources_filename, k_filename = output_filenames(frequency, output_dir)
     
-    sources_data = np.array(sources_data, dtype=np.float64)
-    print(sources_data)
+    # per source: position, then (Re, Im) of every (l, m) in lm_pairs order,
+    # for l_max = 1 the monopole and the m=0, m=-1, m=+1 dipoles
+    sources_data = np.column_stack((
+        positions.reshape(num_sources, 3),
+        coefficients.reshape(num_sources, num_terms(l_max)).view(np.float64)
+    ))
+    log.debug(sources_data)
     
-    with open(sources_filename, "wb") as f:
+    os.makedirs(output_dir, exist_ok=True)
+    with open(f"{sources_filename}.tmp", "wb") as f:
         f.write(sources_data.tobytes())
+    os.replace(f"{sources_filename}.tmp", sources_filename)
 
-    print(f"Exported {sources_filename} with {num_sources} sources.")
+    log.info(f"Exported {sources_filename} with {num_sources} sources.")
 
-    # Write .k file in binary format
-    with open(k_filename, "wb") as f:
+    # Write .k file in binary format, written last so it marks the mode as done,
+    # k is always the last double, other orders than 1 are written before it
+    with open(f"{k_filename}.tmp", "wb") as f:
+        if l_max != 1:
+            f.write(struct.pack("d", l_max))
         f.write(struct.pack("d", k))  # Write one double-precision float
+    os.replace(f"{k_filename}.tmp", k_filename)
 
-    print(f"Exported {k_filename} (wave number = {k:.6f}).")
+    log.info(f"Exported {k_filename} (wave number = {k:.6f}).")
 
-if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print_usage()
-        
-    source_number = int(sys.argv[1])
-    candidates_number = int(sys.argv[2])
+def export_bundle(filename, frequencies, output_dir, dtype=np.float64, directivity=True):
+    # pack the exported .sources/.k files of the given modes into one bundle
+    modes = [read_legacy_mode(output_base(frequency, output_dir)) for frequency in frequencies]
+    if directivity:
+        for mode in modes:
+            mode["directivity"] = bake_directivity(mode["positions"], mode["coefficients"], mode["k"], tolerance=DIRECTIVITY_TOLERANCE)
+    with profiling.stage("export.bundle"):
+        write_bundle(filename, modes, dtype=dtype)
+    log.info(f"Exported {filename} with {len(modes)} modes.")
+
+def sketch_sample_rows(W, sample_points, frequencies, num_rows, method, candidate_pool, basis_func, rng=None):
+    # rows and sqrt weights of a reweighted row sketch shared by the modes at the given frequencies
+    rng = np.random.default_rng(rng)
+    leverage = None
+    if method == "leverage":
+        # leverage of the basis of a few candidates, a proxy for the unknown sources,
+        # summed over the frequencies so every mode keeps the rows it depends on
+        probes = candidate_pool.points[rng.choice(len(candidate_pool.points), min(16, len(candidate_pool.points)), replace=False)]
+        leverage = sum(leverage_scores(apply_weight(W, basis_func(probes, sample_points, frequency))) for frequency in frequencies)
+    return sketch_rows(W, num_rows, rng, leverage)
+
+def sketch_samples(W, sample_points, p_bar_val, frequency, num_rows, method, candidate_pool, basis_func, rng=None):
+    # weights, sample points and p_bar of a reweighted row sketch
+    rows, W_sketch = sketch_sample_rows(W, sample_points, [frequency], num_rows, method, candidate_pool, basis_func, rng)
+    return W_sketch, np.asarray(sample_points)[rows], p_bar_val[:, rows]
 
-    membrane, surface = load_mesh(membrane_path, surface_path)
-    offset(membrane, surface)
+def precompute_mode(membrane, W, sample_points, frequency, p_bar_val, source_number, candidates_number, candidate_pool, output_dir,
+                    l_max=L_MAX, fixed_pool=False, sketch=None, sketch_oversample=SKETCH_OVERSAMPLE, seed=None):
+    log.debug(p_bar_val)
     
-    W, sample_points = init_weight_mat(surface)
+    # (N, T * C) basis of multipoles up to order l_max
+    basis_func = functools.partial(multipole_basis_func, l_max=l_max)
     
-    # bem solver, produce sound pressure evaluation on vertices of membrane
+    # placement and coefficients are fit on a sketch whose rows scale with the
+    # source budget, the fit is then validated on every sample point
+    fit_W, fit_points, fit_p_bar = W, sample_points, p_bar_val
+    num_rows = sketch_oversample * num_terms(l_max) * source_number
+    sketched = sketch is not None and num_rows < len(sample_points)
+    if sketched:
+        with profiling.stage("placement.sketch"):
+            fit_W, fit_points, fit_p_bar = sketch_samples(W, sample_points, p_bar_val, frequency, num_rows, sketch, candidate_pool, basis_func, seed)
+        log.info(f"Fitting on {len(fit_points)} of {len(sample_points)} sample points ({sketch} sketch)")
     
-    for mode in modal_data_plastic:
-        frequency = mode["frequency"]
-        participation = mode["participation"]
-        if np.linalg.norm(participation) < 1e-6:
-            continue
-
-        p_bar_val = p_bar(
-            object_mesh=surface,
-            sample_points=sample_points.T,
-            frequency=frequency,
-            participation=participation
-            )
-        
-        print(p_bar_val)
-        
-        selected_positions = multipole_placement(
+    with profiling.stage("placement", frequency=frequency):
+        selected_positions, factorization = multipole_placement(
             tolerance=1e-3,
-            W = W,
-            p_bar=p_bar_val.T,
+            W = fit_W,
+            p_bar=fit_p_bar.T,
             offset_surface=membrane,
-            sample_points=sample_points,
+            sample_points=fit_points,
             frequency=frequency,
             num_sources=source_number,
             num_candidates=candidates_number,
-            multipole_basis_func=multipole_basis_func
+            multipole_basis_func=basis_func,
+            candidate_pool=candidate_pool,
+            return_factorization=True,
+            l_max=l_max,
+            fixed_pool=fixed_pool
         )
-        
+    
+    coefficients = compute_coefficient(
+        weight=fit_W,
+        multipole_pos=selected_positions,
+        p_bar=fit_p_bar.T,
+        sample_points=fit_points,
+        frequency=frequency,
+        factorization=factorization,
+        l_max=l_max
+    )
+    
+    if sketched:
+        with profiling.stage("placement.validate"):
+            residual = weighted_residual(W, p_bar_val, sample_points, selected_positions, coefficients, frequency, speed_of_sound)
+        log.info(f"Full resolution weighted residual: {residual}")
+        if profiling.enabled():
+            profiling.record(f"validation_residual[{frequency}]", residual)
+
+    log.debug(selected_positions)
+    log.debug(coefficients)
+    export_sound_data(
+        frequency=frequency,
+        positions=selected_positions,
+        coefficients=coefficients,
+        output_dir=output_dir,
+        l_max=l_max
+    )
+    log.info("=========================================")
+
+def precompute_joint(membrane, W, sample_points, modes, p_bars, source_number, candidates_number, candidate_pool, output_dir,
+                     l_max=L_MAX, fixed_pool=False, sketch=None, sketch_oversample=SKETCH_OVERSAMPLE, seed=None):
+    # one placement for all modes, then the coefficients of every mode at the shared positions
+    frequencies = [mode["frequency"] for mode in modes]
+    basis_func = functools.partial(multipole_basis_func, l_max=l_max)
+    
+    # one sketch shared by every mode, the modes are fit on the same rows
+    fit_W, fit_points, fit_p_bars = W, sample_points, p_bars
+    num_rows = sketch_oversample * num_terms(l_max) * source_number
+    sketched = sketch is not None and num_rows < len(sample_points)
+    if sketched:
+        with profiling.stage("placement.sketch"):
+            rows, fit_W = sketch_sample_rows(W, sample_points, frequencies, num_rows, sketch, candidate_pool, basis_func, seed)
+        fit_points = np.asarray(sample_points)[rows]
+        fit_p_bars = [p_bar_val[:, rows] for p_bar_val in p_bars]
+        log.info(f"Fitting on {len(fit_points)} of {len(sample_points)} sample points ({sketch} sketch)")
+    
+    with profiling.stage("placement", frequencies=frequencies):
+        selected_positions, factorizations = joint_multipole_placement(
+            tolerance=1e-3,
+            W=fit_W,
+            p_bars=[p_bar_val.T for p_bar_val in fit_p_bars],
+            frequencies=frequencies,
+            offset_surface=membrane,
+            sample_points=fit_points,
+            num_sources=source_number,
+            num_candidates=candidates_number,
+            multipole_basis_func=basis_func,
+            candidate_pool=candidate_pool,
+            l_max=l_max,
+            fixed_pool=fixed_pool
+        )
+    log.debug(selected_positions)
+    
+    for frequency, p_bar_val, fit_p_bar, factorization in zip(frequencies, p_bars, fit_p_bars, factorizations):
         coefficients = compute_coefficient(
-            weight=W,
+            weight=fit_W,
             multipole_pos=selected_positions,
-            p_bar=p_bar_val.T,
-            sample_points=sample_points,
-            frequency=frequency
+            p_bar=fit_p_bar.T,
+            sample_points=fit_points,
+            frequency=frequency,
+            factorization=factorization,
+            l_max=l_max
         )
-
-        print(selected_positions)
-        print(coefficients)
+        
+        if sketched:
+            with profiling.stage("placement.validate"):
+                residual = weighted_residual(W, p_bar_val, sample_points, selected_positions, coefficients, frequency, speed_of_sound)
+            log.info(f"{frequency}: full resolution weighted residual: {residual}")
+            if profiling.enabled():
+                profiling.record(f"validation_residual[{frequency}]", residual)
+        
+        log.debug(coefficients)
         export_sound_data(
             frequency=frequency,
             positions=selected_positions,
             coefficients=coefficients,
-            output_dir="plastic"
+            output_dir=output_dir,
+            l_max=l_max
         )
-        print("=========================================")
+    log.info("=========================================")
 
-        
-        
\ No newline at end of file
+if __name__ == '__main__':
+    args = parse_args()
+    source_number = args.source_number
+    candidates_number = args.candidates_number
+    
+    profiling.setup_logging(args.log_level)
+    if args.trace:
+        profiling.enable()
+    
+    cache = ArtifactCache(args.cache_dir, enabled=not args.no_cache)
+    if args.clear_cache:
+        cache.clear()
+
+    # processed meshes and their containment grids, cached by the contents of the OBJ files
+    membrane, surface = load_mesh_cached(membrane_path, surface_path, cache)
+    if args.diagnostics:
+        offset(membrane.mesh, surface.mesh)
+    
+    W, sample_points = load_weights(surface, cache)
+    
+    # one candidate pool inside the offset surface, reused by every mode
+    candidate_pool = CandidatePool(membrane, candidates_number, seed=args.seed)
+    
+    modes = [mode for mode in modal_data_plastic if np.linalg.norm(mode["participation"]) >= 1e-6]
+    p_bars = compute_p_bars(surface, sample_points, modes, cache)
+    
+    if args.joint:
+        precompute_joint(
+            membrane=membrane,
+            W=W,
+            sample_points=sample_points,
+            modes=modes,
+            p_bars=p_bars,
+            source_number=source_number,
+            candidates_number=candidates_number,
+            candidate_pool=candidate_pool,
+            output_dir="plastic",
+            l_max=args.l_max,
+            fixed_pool=args.fixed_pool,
+            sketch=args.sketch,
+            sketch_oversample=args.sketch_oversample,
+            seed=args.seed
+        )
+    else:
+        for mode, p_bar_val in zip(modes, p_bars):
+            precompute_mode(
+                membrane=membrane,
+                W=W,
+                sample_points=sample_points,
+                frequency=mode["frequency"],
+                p_bar_val=p_bar_val,
+                source_number=source_number,
+                candidates_number=candidates_number,
+                candidate_pool=candidate_pool,
+                output_dir="plastic",
+                l_max=args.l_max,
+                fixed_pool=args.fixed_pool,
+                sketch=args.sketch,
+                sketch_oversample=args.sketch_oversample,
+                seed=args.seed
+            )
+    
+    export_bundle("plastic.pat", [mode["frequency"] for mode in modes], "plastic")
+    
+    if args.trace:
+        profiling.disable().write(args.trace)
+        log.info(f"Wrote trace {args.trace}")
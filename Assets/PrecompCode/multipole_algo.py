@@ -1,15 +1,64 @@
+import contextlib
+import tempfile
+
 import numpy as np
-from geometry import init_weight_mat, generate_candidate_points
-from multipole_util import modified_gram_schmidt
 
-def pick_multipole(residual, candidate_points, sample_points, weight_mat, multipole_basis_func, frequency):
-    '''pick multipole that minimizes the error of bem'''
+import profiling
+from profiling import log
+from geometry import CandidatePool
+from multipole_util import modified_gram_schmidt, apply_weight, OrthoBasis, num_terms, L_MAX
+
+# number of candidates scored together in pick_multipole
+BLOCK_SIZE = 64
+
+# fraction of the candidate pool redrawn before every greedy iteration
+REFRESH_FRACTION = 0.25
+
+# candidate bases larger than this are kept in a memory-mapped file
+SPILL_BYTES = 1 << 30
+
+# relative eigenvalue cutoff of the projected candidate gram matrices
+EIG_CUTOFF = 1e-10
+
+def pick_multipole(residual, candidate_points, sample_points, weight_mat, multipole_basis_func, frequency, block_size=BLOCK_SIZE):
+    '''pick multipole that minimizes the error of bem
+
+    candidates are scored block_size at a time as a (C, N, T) stack, pass
+    block_size=None to score them one by one
+    '''
+    if block_size is None:
+        return _pick_multipole_loop(residual, candidate_points, sample_points, weight_mat, multipole_basis_func, frequency)
+
+    scores = candidate_scores(residual, candidate_points, sample_points, weight_mat, multipole_basis_func, frequency, block_size)
+    if len(scores) == 0:
+        return None
+    return np.asarray(candidate_points)[np.argmax(scores)]
+
+def candidate_scores(residual, candidate_points, sample_points, weight_mat, multipole_basis_func, frequency, block_size=BLOCK_SIZE):
+    # norm of the residual projected on the weighted basis of every candidate, (C,)
+    residual = np.ravel(residual)
+    N = len(residual)
+    scores = np.empty(len(candidate_points))
+
+    for start in range(0, len(candidate_points), block_size):
+        block = np.asarray(candidate_points[start:start + block_size])
+
+        # (N, TC) -> (C, N, T), one weighted basis per candidate
+        V = multipole_basis_func(block, sample_points, frequency)
+        WV = apply_weight(weight_mat, V).reshape(N, len(block), -1).transpose(1, 0, 2)
+        U, _ = np.linalg.qr(WV)
+
+        scores[start:start + len(block)] = np.linalg.norm(np.einsum('cnj,n->cj', U.conj(), residual), axis=1)
+
+    return scores
+
+def _pick_multipole_loop(residual, candidate_points, sample_points, weight_mat, multipole_basis_func, frequency):
     best_score = -np.inf
     best_pos = None
     
     for candidate in candidate_points:        
         V_x = multipole_basis_func(candidate, sample_points, frequency)
-        WV_x = weight_mat @ V_x
+        WV_x = apply_weight(weight_mat, V_x)
         U_x, _ = np.linalg.qr(WV_x)
         score = np.linalg.norm(U_x.T.conj() @ residual, 2)
         
@@ -21,7 +70,13 @@ def pick_multipole(residual, candidate_points, sample_points, weight_mat, multip
 
 def expand_subspace_and_update_residual(Q, r, new_position, sample_points, weight_mat, multipole_basis_func, frequency):
     V_x = multipole_basis_func(new_position, sample_points, frequency)
-    WV_x = weight_mat @ V_x
+    WV_x = apply_weight(weight_mat, V_x)
+    
+    # only the new block is orthogonalized, the residual is updated in place
+    if isinstance(Q, OrthoBasis):
+        Q_x = Q.append(WV_x)
+        r -= Q_x @ (Q_x.T.conj() @ r)
+        return Q, r
     
     QWV_x = np.hstack((Q, WV_x)) if Q.size > 0 else WV_x
     Q_new = modified_gram_schmidt(QWV_x)
@@ -34,39 +89,236 @@ def expand_subspace_and_update_residual(Q, r, new_position, sample_points, weigh
     return Q_new, r
 
     
-def multipole_placement(tolerance, W, p_bar, offset_surface, sample_points, frequency, num_sources, num_candidates, multipole_basis_func):
+class ProjectedCandidates:
+    '''weighted bases A_c = W V_c of a fixed candidate pool, scored against the placement subspace
+
+    every candidate keeps G_c = B_c^H B_c and g_c = A_c^H r with B_c = (I - Q Q^H) A_c,
+    r is orthogonal to Q so g_c = B_c^H r and the score ||proj_{B_c} r|| is
+    sqrt(g_c^H G_c^+ g_c), G_c and g_c are downdated by P^H P and P^H Q_new^H r with
+    P = Q_new^H A_c after every selection so a greedy step costs O(C N T p) for p
+    new columns of Q
+
+    the (C, N, T) stack is kept in memory up to spill_bytes and in a temporary
+    memory-mapped file otherwise
+    '''
+
+    def __init__(self, candidate_points, sample_points, weight_mat, multipole_basis_func, frequency, residual,
+                 block_size=BLOCK_SIZE, spill_bytes=SPILL_BYTES, spill_dir=None):
+        self.points = np.array(candidate_points, dtype=np.float64).reshape(-1, 3)
+        self.block_size = block_size
+        C, N = len(self.points), len(residual)
+        r = np.ravel(residual)
+
+        def weighted_basis(start):
+            block = self.points[start:start + block_size]
+            V = multipole_basis_func(block, sample_points, frequency)
+            return apply_weight(weight_mat, V).reshape(N, len(block), -1).transpose(1, 0, 2)
+
+        # the first block gives the number of terms, the stack is filled one block at a time
+        WV = weighted_basis(0) if C > 0 else None
+        T = WV.shape[2] if C > 0 else num_terms(L_MAX)
+
+        shape = (C, N, T)
+        self._spill_file = None
+        if C * N * T * 16 > spill_bytes:
+            self._spill_file = tempfile.TemporaryFile(dir=spill_dir)
+            self.A = np.memmap(self._spill_file, dtype=np.complex128, mode="w+", shape=shape)
+        else:
+            self.A = np.empty(shape, dtype=np.complex128)
+
+        self.G = np.empty((C, T, T), dtype=np.complex128)
+        self.g = np.empty((C, T), dtype=np.complex128)
+        for start in range(0, C, block_size):
+            if start > 0:
+                WV = weighted_basis(start)
+            self.A[start:start + len(WV)] = WV
+            self.G[start:start + len(WV)] = WV.conj().transpose(0, 2, 1) @ WV
+            self.g[start:start + len(WV)] = np.einsum('cnt,n->ct', WV.conj(), r)
+            # released before the next block is evaluated
+            del WV
+        # eigenvalues below EIG_CUTOFF times the largest one of the unprojected
+        # candidate are directions already spanned by Q
+        self.scale = np.linalg.eigvalsh(self.G)[:, -1] if C > 0 else np.empty(0)
+
+    def scores(self):
+        w, U = np.linalg.eigh(self.G)
+        proj = np.abs(np.einsum('ctj,ct->cj', U.conj(), self.g))**2
+        keep = w > EIG_CUTOFF * self.scale[:, None]
+        return np.sqrt(np.sum(np.where(keep, proj / np.where(keep, w, 1.0), 0.0), axis=1))
+
+    def update(self, Q_new, r):
+        # project out the new columns of Q, r is the residual before they were projected out,
+        # with P = Q_new^H A_c the correlation drops by P^H Q_new^H r
+        Q_new_H = np.asarray(Q_new).conj().T
+        q = Q_new_H @ np.ravel(r)
+        for start in range(0, len(self.G), self.block_size):
+            P = Q_new_H @ self.A[start:start + self.block_size]
+            P_H = P.conj().transpose(0, 2, 1)
+            self.G[start:start + self.block_size] -= P_H @ P
+            self.g[start:start + self.block_size] -= P_H @ q
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._spill_file is not None:
+            del self.A
+            self._spill_file.close()
+            self._spill_file = None
+
+def multipole_placement(tolerance, W, p_bar, offset_surface, sample_points, frequency, num_sources, num_candidates, multipole_basis_func, block_size=BLOCK_SIZE, candidate_pool=None, refresh_fraction=REFRESH_FRACTION, return_factorization=False, l_max=L_MAX, fixed_pool=False):
     # residual
-    print(W.shape, p_bar.shape)
-    r = W @ p_bar
-    r = r / np.linalg.norm(r)
+    log.debug(f"weights {W.shape}, p_bar {p_bar.shape}")
+    r = np.array(apply_weight(W, p_bar), dtype=np.complex128)
+    r /= np.linalg.norm(r)
     
-    # init Q subspace
-    Q = np.zeros((len(p_bar), 0), dtype=np.complex128)
+    # init Q subspace, one column per (l, m) of every source,
+    # multipole_basis_func has to evaluate multipoles of the same order l_max
+    Q = OrthoBasis(len(p_bar), num_terms(l_max) * num_sources)
     
     # init selected positions
     selected_positions = []
     
-    print("Start Multipole Placement -------------------")
-    print(f"Initial residual norm: {np.linalg.norm(r, 2)}")
+    # candidates are drawn once and partially refreshed, the pool can be shared across modes
+    if candidate_pool is None:
+        with profiling.stage("placement.candidates"):
+            candidate_pool = CandidatePool(offset_surface, num_candidates)
     
-    while np.linalg.norm(r, 2) > tolerance and len(selected_positions) < num_sources:
-        print(f"finding source {len(selected_positions) + 1}")
-        
-        # generate candidate points
-        candidate_points = generate_candidate_points(offset_surface, num_candidates)
-        
-        # pick multipole that minimizes the error of bem
-        best_pos = pick_multipole(r, candidate_points, sample_points, W, multipole_basis_func, frequency)
+    # the candidate bases are released when placement ends or raises
+    with contextlib.ExitStack() as stack:
+        # with a fixed pool the candidate bases are evaluated once and only projected afterwards
+        projected = None
+        if fixed_pool:
+            with profiling.stage("placement.candidate_bases"):
+                projected = stack.enter_context(
+                    ProjectedCandidates(candidate_pool.points, sample_points, W, multipole_basis_func, frequency, r, block_size))
         
-        if best_pos is None:
-            continue
+        log.info("Start Multipole Placement -------------------")
+        residual_norm = np.linalg.norm(r, 2)
+        log.info(f"Initial residual norm: {residual_norm}")
+        if profiling.enabled():
+            profiling.record(f"residual[{frequency}]", residual_norm)
         
-        # update Q subspace
-        Q, r = expand_subspace_and_update_residual(Q, r, best_pos, sample_points, W, multipole_basis_func, frequency) 
+        while residual_norm > tolerance and len(selected_positions) < num_sources:
+            log.debug(f"finding source {len(selected_positions) + 1}")
+            
+            if projected is not None:
+                with profiling.stage("placement.score"):
+                    scores = projected.scores()
+                if len(scores) == 0 or scores.max() <= 0:
+                    log.info("No candidate reduces the residual further")
+                    break
+                best_pos = projected.points[np.argmax(scores)]
+            else:
+                # refresh candidate points
+                if selected_positions:
+                    with profiling.stage("placement.candidates"):
+                        candidate_pool.refresh(refresh_fraction)
+                candidate_points = candidate_pool.points
+                
+                # pick multipole that minimizes the error of bem
+                with profiling.stage("placement.score"):
+                    best_pos = pick_multipole(r, candidate_points, sample_points, W, multipole_basis_func, frequency, block_size)
+            
+            if best_pos is None:
+                continue
+            
+            # update Q subspace
+            with profiling.stage("placement.update"):
+                # the residual is updated in place, the candidates need the one before
+                r_old = r.copy() if projected is not None else None
+                Q, r = expand_subspace_and_update_residual(Q, r, best_pos, sample_points, W, multipole_basis_func, frequency) 
+                if projected is not None:
+                    projected.update(Q.Q[:, -projected.G.shape[1]:], r_old)
+            
+            residual_norm = np.linalg.norm(r, 2)
+            log.info(f"Residual norm: {residual_norm}")
+            if profiling.enabled():
+                profiling.record(f"residual[{frequency}]", residual_norm)
+            
+            # update selected positions
+            selected_positions.append(np.array(best_pos))
+    
+    # Q and R of the weighted basis at the selected positions, for compute_coefficient
+    if return_factorization:
+        return selected_positions, Q
+    return selected_positions
+
+def joint_multipole_placement(tolerance, W, p_bars, frequencies, offset_surface, sample_points, num_sources, num_candidates, multipole_basis_func, block_size=BLOCK_SIZE, candidate_pool=None, refresh_fraction=REFRESH_FRACTION, l_max=L_MAX, fixed_pool=False):
+    '''greedy placement of one set of positions shared by every mode of an object
+
+    every mode keeps its own residual and subspace, a candidate is scored by the
+    sum of its squared per-mode scores, placement stops when every residual is
+    below tolerance or num_sources are placed
+
+    returns the positions and the factorization of every mode, for compute_coefficient
+    '''
+    num_modes = len(frequencies)
+    residuals = []
+    for p_bar in p_bars:
+        r = np.ravel(np.array(apply_weight(W, p_bar), dtype=np.complex128))
+        residuals.append(r / np.linalg.norm(r))
+    Qs = [OrthoBasis(len(residuals[0]), num_terms(l_max) * num_sources) for _ in range(num_modes)]
+    
+    selected_positions = []
+    if candidate_pool is None:
+        with profiling.stage("placement.candidates"):
+            candidate_pool = CandidatePool(offset_surface, num_candidates)
+    
+    with contextlib.ExitStack() as stack:
+        projected = None
+        if fixed_pool:
+            with profiling.stage("placement.candidate_bases"):
+                projected = [
+                    stack.enter_context(
+                        ProjectedCandidates(candidate_pool.points, sample_points, W, multipole_basis_func, frequency, r, block_size))
+                    for frequency, r in zip(frequencies, residuals)
+                ]
         
-        print(f"Residual norm: {np.linalg.norm(r, 2)}")
+        log.info(f"Start Joint Multipole Placement of {num_modes} modes -------------------")
         
-        # update selected positions
-        selected_positions.append(best_pos)
+        def residual_norms():
+            return [np.linalg.norm(r) for r in residuals]
         
-    return selected_positions
+        norms = residual_norms()
+        while max(norms) > tolerance and len(selected_positions) < num_sources:
+            log.debug(f"finding source {len(selected_positions) + 1}")
+            
+            if projected is None and selected_positions:
+                with profiling.stage("placement.candidates"):
+                    candidate_pool.refresh(refresh_fraction)
+            
+            with profiling.stage("placement.score"):
+                if projected is not None:
+                    candidate_points = projected[0].points
+                    scores = sum(candidates.scores()**2 for candidates in projected)
+                else:
+                    candidate_points = candidate_pool.points
+                    scores = sum(
+                        candidate_scores(r, candidate_points, sample_points, W, multipole_basis_func, frequency, block_size)**2
+                        for frequency, r in zip(frequencies, residuals)
+                    )
+            if len(scores) == 0 or scores.max() <= 0:
+                log.info("No candidate reduces the residuals further")
+                break
+            best_pos = np.array(candidate_points[np.argmax(scores)])
+            
+            with profiling.stage("placement.update"):
+                for j, frequency in enumerate(frequencies):
+                    r_old = residuals[j].copy() if projected is not None else None
+                    Qs[j], residuals[j] = expand_subspace_and_update_residual(Qs[j], residuals[j], best_pos, sample_points, W, multipole_basis_func, frequency)
+                    if projected is not None:
+                        projected[j].update(Qs[j].Q[:, -projected[j].G.shape[1]:], r_old)
+            
+            norms = residual_norms()
+            log.info(f"Residual norms: {norms}")
+            if profiling.enabled():
+                for frequency, norm in zip(frequencies, norms):
+                    profiling.record(f"residual[{frequency}]", norm)
+            
+            selected_positions.append(best_pos)
+    
+    return selected_positions, Qs
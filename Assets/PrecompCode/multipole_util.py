@@ -1,6 +1,18 @@
+import functools
+import math
+
 import numpy as np
+import scipy.linalg
 import scipy.special
 
+import profiling
+
+def sph_harm(m, l, phi, theta):
+    # scipy.special.sph_harm argument order, it was replaced by sph_harm_y in scipy 1.15
+    if hasattr(scipy.special, "sph_harm_y"):
+        return scipy.special.sph_harm_y(l, m, theta, phi)
+    return scipy.special.sph_harm(m, l, phi, theta)
+
 def spherical_coords(x, center):
     diff = x - center
     r = np.linalg.norm(diff)
@@ -13,23 +25,173 @@ def psi_val(l, m, k, r, theta, phi):
     hankel_val = scipy.special.spherical_jn(l, k * r) - 1j * scipy.special.spherical_yn(l, k * r)
     if np.isnan(hankel_val).any() or np.isinf(hankel_val).any():
         hankel_val = 0.0
-    spherical_harm_val = scipy.special.sph_harm(m, l, phi, theta)
+    spherical_harm_val = sph_harm(m, l, phi, theta)
     psi_lm = hankel_val * spherical_harm_val
     return psi_lm
 
-def multipole_basis_func(x, sample_points, frequency, speed_of_sound=343):
+# Y_00 (scipy convention), start of the spherical harmonic recurrences
+Y00 = 0.5 / math.sqrt(math.pi)
+
+# default multipole order, a monopole and three dipoles per source
+L_MAX = 1
+
+# max number of (sample, source) pairs evaluated at once, bounds temporaries
+CHUNK_SIZE = 1 << 18
+
+def num_terms(l_max):
+    return (l_max + 1) ** 2
+
+def lm_pairs(l_max):
+    # column order of one source, m = 0, -1, 1, -2, 2, ... for every l
+    return [(l, sign * m) for l in range(l_max + 1) for m in range(l + 1) for sign in ((1,) if m == 0 else (-1, 1))]
+
+def order_from_terms(terms):
+    l_max = math.isqrt(terms) - 1
+    if terms == 0 or num_terms(l_max) != terms:
+        raise ValueError(f"{terms} coefficients per source is not a multipole order")
+    return l_max
+
+def _column(l, m):
+    # index of (l, m) in lm_pairs
+    return l * l + (0 if m == 0 else 2 * abs(m) - (m < 0))
+
+@functools.lru_cache(maxsize=None)
+def _legendre_coefficients(l_max):
+    # recurrences of P_lm = Y_lm / ((x + iy) / r)^m, a polynomial in z / r
+    #   P_mm = -sqrt((2m + 1) / 2m) P_m-1,m-1 starting from P_00 = Y00
+    #   P_lm = a_lm (z P_l-1,m - b_lm P_l-2,m)
+    diagonal = [Y00]
+    for m in range(1, l_max + 1):
+        diagonal.append(-math.sqrt((2 * m + 1) / (2 * m)) * diagonal[-1])
+    a = {}
+    b = {}
+    for m in range(l_max + 1):
+        for l in range(m + 1, l_max + 1):
+            a[l, m] = math.sqrt((4 * l * l - 1) / (l * l - m * m))
+            b[l, m] = math.sqrt(((l - 1) ** 2 - m * m) / (4 * (l - 1) ** 2 - 1))
+    return diagonal, a, b
+
+def spherical_hankel(l_max, kr):
+    # h_l = j_l - i y_l for l = 0 .. l_max by upward recurrence from
+    # h_-1 = e^{-ix} / x and h_0 = i e^{-ix} / x, stable since y_l dominates
+    previous = np.exp(-1j * kr) / kr
+    h = [1j * previous]
+    for l in range(l_max):
+        previous, h_next = h[-1], (2 * l + 1) / kr * h[-1] - previous
+        h.append(h_next)
+    return h
+
+def spherical_harmonics(l_max, x, y, z, out):
+    # Y_lm at the unit vectors (x, y, z), written to out[..., _column(l, m)]
+    diagonal, a, b = _legendre_coefficients(l_max)
+    w = x + 1j * y
+    w_power = None
+    for m in range(l_max + 1):
+        # Y_lm = P_lm w^m and Y_l,-m = (-1)^m P_lm conj(w)^m for l = m .. l_max
+        P_prev, P = 0.0, diagonal[m]
+        for l in range(m, l_max + 1):
+            if l > m:
+                P_prev, P = P, a[l, m] * (z * P - b[l, m] * P_prev)
+            if m == 0:
+                out[..., _column(l, 0)] = P
+            else:
+                out[..., _column(l, m)] = P * w_power
+                out[..., _column(l, -m)] = (-1) ** m * P * w_power.conj()
+        w_power = w if w_power is None else w_power * w
+    return out
+
+def multipole_basis(sample_points, sources, frequency, speed_of_sound=343, chunk_size=CHUNK_SIZE, l_max=L_MAX):
+    '''evaluate the multipoles up to order l_max of every source at every sample point
+
+    returns V of shape (N, T * S) with T = (l_max + 1)^2, column T * j + i holds
+    the i-th pair of lm_pairs(l_max) of source j, for l_max = 1 the pairs
+    (0,0), (1,0), (1,-1), (1,1) in the same layout as the scalar psi_val path
+    '''
     k = 2 * np.pi * frequency / speed_of_sound
-    N = len(sample_points)
+    return multipole_basis_k(sample_points, sources, k, chunk_size, l_max=l_max)
+
+def multipole_basis_k(sample_points, sources, k, chunk_size=CHUNK_SIZE, dtype=np.float64, l_max=L_MAX):
+    # multipole_basis for a wavenumber k, dtype=np.float32 evaluates in single precision
+    sample_points = np.asarray(sample_points, dtype=dtype).reshape(-1, 3)
+    sources = np.asarray(sources, dtype=dtype).reshape(-1, 3)
+    N, S, T = len(sample_points), len(sources), num_terms(l_max)
+    real = np.dtype(dtype).type
+    k = real(k)
+
+    V = np.empty((N, S, T), dtype=np.result_type(dtype, np.complex64))
+    rows = max(1, chunk_size // max(S, 1))
+
+    for start in range(0, N, rows):
+        stop = min(start + rows, N)
+        diff = sample_points[start:stop, None, :] - sources[None, :, :]
+        r = np.maximum(np.sqrt(np.einsum('nsi,nsi->ns', diff, diff)), real(1e-10))
+        x, y, z = np.moveaxis(diff, -1, 0) / r
+
+        # all Y_lm in one pass, then the columns of degree l scaled by h_l(kr)
+        block = spherical_harmonics(l_max, x, y, z, V[start:stop])
+        for l, h in enumerate(spherical_hankel(l_max, k * r)):
+            block[..., l * l:(l + 1) ** 2] *= h[..., None]
+
+    return V.reshape(N, T * S)
+
+def multipole_pressure(sample_points, sources, coefficients, k, chunk_size=CHUNK_SIZE, dtype=np.float64, l_max=None):
+    # V @ coefficients evaluated chunk by chunk, the full basis is never stored,
+    # by default the order follows from the number of coefficients per source
+    return multipole_pressures(sample_points, sources, [coefficients], [k], chunk_size, dtype, l_max)[:, 0]
 
-    lm_pairs = [(0,0), (1,0), (1,-1), (1,1)]
-    V_x = np.zeros((N, 4), dtype=np.complex128)
+def multipole_pressures(sample_points, sources, coefficients, ks, chunk_size=CHUNK_SIZE, dtype=np.float64, l_max=None):
+    '''pressure of several modes with the same sources, shape (N, modes)
 
-    for idx, sample in enumerate(sample_points):
-        r, theta, phi = spherical_coords(sample, x)      
-        for j, (l, m) in enumerate(lm_pairs):
-            V_x[idx, j] = psi_val(l, m, k, r, theta, phi)
+    coefficients and ks hold one entry per mode, r and Y_lm of every
+    (sample, source) pair are evaluated once per chunk and shared by the modes,
+    only h_l(kr) and the sum over the coefficients are evaluated per mode
+    '''
+    sample_points = np.asarray(sample_points, dtype=dtype).reshape(-1, 3)
+    sources = np.asarray(sources, dtype=dtype).reshape(-1, 3)
+    N, S = len(sample_points), len(sources)
+    complex_dtype = np.result_type(dtype, np.complex64)
+    real = np.dtype(dtype).type
 
-    return V_x
+    p = np.zeros((N, len(ks)), dtype=complex_dtype)
+    if S == 0:
+        return p
+    coefficients = [np.ravel(c) for c in coefficients]
+    if l_max is None:
+        l_max = order_from_terms(len(coefficients[0]) // S)
+    T = num_terms(l_max)
+    # (modes, S, T) coefficients and the first column of every degree l
+    C = np.stack([c.reshape(S, T) for c in coefficients]).astype(complex_dtype)
+    degrees = np.array([l * l for l in range(l_max + 1)])
+
+    rows = max(1, chunk_size // S)
+    Y = np.empty((min(rows, N), S, T), dtype=complex_dtype)
+    for start in range(0, N, rows):
+        stop = min(start + rows, N)
+        diff = sample_points[start:stop, None, :] - sources[None, :, :]
+        r = np.maximum(np.sqrt(np.einsum('nsi,nsi->ns', diff, diff)), real(1e-10))
+        x, y, z = np.moveaxis(diff, -1, 0) / r
+        Y_chunk = spherical_harmonics(l_max, x, y, z, Y[:stop - start])
+
+        for j, k in enumerate(ks):
+            # sum_m c_lm Y_lm per degree, then sum over l and sources of h_l(kr) times it
+            YC = np.add.reduceat(Y_chunk * C[j], degrees, axis=2)
+            h = np.stack(spherical_hankel(l_max, real(k) * r), axis=-1)
+            p[start:stop, j] = np.einsum('nsl,nsl->n', YC, h)
+    return p
+
+def multipole_basis_func(x, sample_points, frequency, speed_of_sound=343, l_max=L_MAX):
+    # x is a source position (3,) or a block of them (C, 3), result is (N, T * C)
+    return multipole_basis(sample_points, x, frequency, speed_of_sound, l_max=l_max)
+
+def weight_vector(weight):
+    # diagonal of W, accepts the (N,) vector or the legacy dense (N, N) matrix
+    weight = np.asarray(weight, dtype=np.float64)
+    return np.diag(weight) if weight.ndim == 2 else weight
+
+def apply_weight(weight, A):
+    # W @ A as a row scaling
+    w = weight_vector(weight)
+    return w.reshape((-1,) + (1,) * (np.ndim(A) - 1)) * A
 
 def modified_gram_schmidt(A: np.ndarray) -> np.ndarray:
     n = A.shape[1]
@@ -46,44 +208,129 @@ def modified_gram_schmidt(A: np.ndarray) -> np.ndarray:
 
     return Q
 
+class OrthoBasis:
+    '''append-only orthonormal basis, the appended columns A satisfy A = Q R
 
-# For real-time computation
-def fin_multipole(sample_points, sources, frequency, speed_of_sound=343):
-    # wave number
-    k = 2 * np.pi * frequency / speed_of_sound
-    N = len(sample_points)
-    M = len(sources)
+    Q and R are preallocated for capacity columns and grow when it is exceeded
+    '''
     
-    # init basis
-    # V_ij, jth multipole function evaluated at ith point
-    lm_pairs = [(0,0), (1,0), (1,-1), (1,1)]
-    V = np.zeros((N, M * len(lm_pairs)), dtype=np.complex128)
+    def __init__(self, num_rows, capacity):
+        self.size = 0
+        self._Q = np.zeros((num_rows, capacity), dtype=np.complex128)
+        self._R = np.zeros((capacity, capacity), dtype=np.complex128)
+    
+    @property
+    def Q(self):
+        return self._Q[:, :self.size]
+    
+    @property
+    def R(self):
+        return self._R[:self.size, :self.size]
     
-    for i, sample in enumerate(sample_points):
-        for j, source in enumerate(sources):
-            r, theta, phi = spherical_coords(sample, source)
-            for k, (l, m) in enumerate(lm_pairs):
-                V[i, j * len(lm_pairs) + k] = psi_val(l, m, k, r, theta, phi)
-    return V
+    def _grow(self, capacity):
+        Q = np.zeros((self._Q.shape[0], capacity), dtype=np.complex128)
+        R = np.zeros((capacity, capacity), dtype=np.complex128)
+        Q[:, :self.size] = self.Q
+        R[:self.size, :self.size] = self.R
+        self._Q, self._R = Q, R
+    
+    def append(self, A):
+        # block classical gram-schmidt against the existing columns with one
+        # reorthogonalization pass, then a small QR of the new block
+        A = np.asarray(A, dtype=np.complex128).reshape(self._Q.shape[0], -1)
+        n, p = self.size, A.shape[1]
+        if n + p > self._Q.shape[1]:
+            self._grow(max(2 * self._Q.shape[1], n + p))
+        
+        Q = self.Q
+        B = A.copy()
+        C = Q.conj().T @ B
+        B -= Q @ C
+        C_re = Q.conj().T @ B
+        B -= Q @ C_re
+        Q_new, R_new = np.linalg.qr(B)
+        
+        self._Q[:, n:n + p] = Q_new
+        self._R[:n, n:n + p] = C + C_re
+        self._R[n:n + p, n:n + p] = R_new
+        self.size = n + p
+        return self._Q[:, n:n + p]
 
 
-def compute_coefficient(weight, multipole_pos, p_bar, sample_points, frequency):
+# For real-time computation
+def fin_multipole(sample_points, sources, frequency, speed_of_sound=343, l_max=L_MAX):
+    # V_ij, jth multipole function evaluated at ith point
+    return multipole_basis(sample_points, sources, frequency, speed_of_sound, l_max=l_max)
+
+
+# relative size of the smallest diagonal entry of R below which the
+# placement factorization is considered rank deficient
+RCOND = 1e-8
+
+@profiling.profiled("coefficients.solve")
+def compute_coefficient(weight, multipole_pos, p_bar, sample_points, frequency, factorization=None, l_max=L_MAX):
     # minimize the difference between p(x) and p_bar(x) with coefficient c
+    b = np.array(apply_weight(weight, p_bar), dtype=np.complex128)
+    
+    # W V = Q R from placement, c = R^-1 Q^H W p_bar
+    if factorization is not None:
+        R = factorization.R
+        diag = np.abs(np.diag(R))
+        if len(diag) > 0 and diag.min() > RCOND * diag.max():
+            c = scipy.linalg.solve_triangular(R, factorization.Q.T.conj() @ b)
+            return np.array(c, dtype=np.complex128)
     
     # for all sample points, N, we can find the 
     # corresponding multipole basis function V(x_i)
-    V = fin_multipole(sample_points, multipole_pos, frequency)
+    V = fin_multipole(sample_points, multipole_pos, frequency, l_max=l_max)
     
-    weight = np.array(weight, dtype=np.float64)
-    b = np.array(weight @ p_bar, dtype=np.complex128)
-    
-    U, S, VT = np.linalg.svd(weight @ V, full_matrices=False)
+    U, S, VT = np.linalg.svd(apply_weight(weight, V), full_matrices=False)
     S_truncated = np.zeros_like(S)
     mask = S > 1e-6
     S_truncated[mask] = 1.0 / S[mask]
     
-    A_pinv = np.array(VT.T @ np.diag(S_truncated) @ U.T, dtype=np.complex128)
+    # pseudoinverse V S^-1 U^H, the singular vectors are complex
+    A_pinv = VT.T.conj() @ (S_truncated[:, None] * U.T.conj())
     
     c = np.array(A_pinv @ b, dtype=np.complex128)    
     return c
-    
+
+
+# rows of a sketch per basis column, m = SKETCH_OVERSAMPLE * T * num_sources
+SKETCH_OVERSAMPLE = 8
+
+# share of the area distribution mixed into leverage score sampling, keeps
+# every part of the surface reachable when a few rows dominate the leverage
+LEVERAGE_MIX = 0.5
+
+def leverage_scores(A):
+    # squared row norms of an orthonormal basis of the column space of A
+    Q, _ = np.linalg.qr(A)
+    return np.sum(np.abs(Q)**2, axis=1)
+
+def sketch_rows(weight, num_rows, rng=None, leverage=None):
+    '''importance sample num_rows rows, by area or mixed with leverage scores
+
+    every draw of row i adds w_i^2 / (num_rows pi_i) to its weight, total_area / num_rows
+    for pure area sampling, so the sketched weighted norm is an unbiased estimate
+    of the full one, duplicate draws are merged into one row
+
+    returns the sorted row indices and the sqrt weights of the sketch
+    '''
+    rng = np.random.default_rng(rng)
+    area = weight_vector(weight)**2
+    probabilities = area / area.sum()
+    if leverage is not None:
+        probabilities = LEVERAGE_MIX * probabilities + (1 - LEVERAGE_MIX) * leverage / leverage.sum()
+
+    draws = rng.choice(len(area), size=num_rows, p=probabilities)
+    rows, counts = np.unique(draws, return_counts=True)
+    return rows, np.sqrt(counts * area[rows] / (num_rows * probabilities[rows]))
+
+def weighted_residual(weight, p_bar, sample_points, multipole_pos, coefficients, frequency, speed_of_sound=343):
+    # ||W (p - p_bar)|| / ||W p_bar|| of the fitted sources at every sample point
+    k = 2 * np.pi * frequency / speed_of_sound
+    w = weight_vector(weight)
+    p_bar = np.ravel(p_bar)
+    p = multipole_pressure(sample_points, multipole_pos, coefficients, k)
+    return np.linalg.norm(w * (p - p_bar)) / np.linalg.norm(w * p_bar)
@@ -0,0 +1,228 @@
+import argparse
+import os
+
+import numpy as np
+
+from directivity import bake_directivity
+from multipole_util import num_terms
+
+# one bundle per object, all modes of the object in a single file
+#
+#   header       HEADER_DTYPE
+#   mode table   mode_count x MODE_DTYPE, at header["table_offset"]
+#   blocks       per mode, positions (S, 3) and coefficients (S, (order + 1)^2),
+#                each block starts on an ALIGNMENT byte boundary, modes with
+#                identical positions point to one shared positions block
+#   directivity  optional per mode (version 2), center (3,) and radii (R,) as
+#                float64 followed by float32 |p| r of shape (R, theta, phi)
+#
+# everything is little endian, positions are stored as float32 or float64 and
+# coefficients as the matching complex type
+MAGIC = b"PATBNDL\0"
+VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+
+# validation error the baked directivity tables are refined to
+DIRECTIVITY_TOLERANCE = 0.05
+ALIGNMENT = 64
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("mode_count", "<u4"),
+    ("dtype", "<u4"),
+    ("alignment", "<u4"),
+    ("table_offset", "<u8"),
+    ("reserved", "V32"),
+])
+
+MODE_DTYPE = np.dtype([
+    ("frequency", "<f8"),
+    ("k", "<f8"),
+    ("source_count", "<u4"),
+    ("order", "<u4"),
+    ("positions_offset", "<u8"),
+    ("coefficients_offset", "<u8"),
+    # reserved in version 1, a zero offset means no directivity table
+    ("directivity_offset", "<u8"),
+    ("directivity_radii", "<u4"),
+    ("directivity_theta", "<u4"),
+    ("directivity_phi", "<u4"),
+    ("directivity_error", "<f4"),
+])
+
+# header dtype code -> (position dtype, coefficient dtype)
+PAYLOAD_DTYPES = {
+    0: (np.dtype("<f8"), np.dtype("<c16")),
+    1: (np.dtype("<f4"), np.dtype("<c8")),
+}
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+def write_bundle(filename, modes, dtype=np.float64):
+    '''write modes to a bundle file
+
+    modes: sequence of dicts with frequency, k, positions (S, 3),
+           coefficients (S * (order + 1)^2,) and optionally order (default 1)
+           and directivity, a table from directivity.bake_directivity
+    '''
+    dtype_code = 1 if np.dtype(dtype) == np.float32 else 0
+    position_dtype, coefficient_dtype = PAYLOAD_DTYPES[dtype_code]
+
+    table = np.zeros(len(modes), dtype=MODE_DTYPE)
+    offset = _align(HEADER_DTYPE.itemsize) + _align(MODE_DTYPE.itemsize * len(modes))
+    blocks = []
+    # positions bytes -> offset of the block already holding them
+    position_offsets = {}
+    for i, mode in enumerate(modes):
+        order = mode.get("order", 1)
+        positions = np.ascontiguousarray(mode["positions"], dtype=position_dtype).reshape(-1, 3)
+        coefficients = np.ascontiguousarray(mode["coefficients"], dtype=coefficient_dtype)
+        coefficients = coefficients.reshape(len(positions), num_terms(order))
+
+        table[i]["frequency"] = mode["frequency"]
+        table[i]["k"] = mode["k"]
+        table[i]["source_count"] = len(positions)
+        table[i]["order"] = order
+        shared_offset = position_offsets.get(positions.tobytes())
+        if shared_offset is not None:
+            table[i]["positions_offset"] = shared_offset
+            positions = None
+        else:
+            position_offsets[positions.tobytes()] = offset
+            table[i]["positions_offset"] = offset
+            offset = _align(offset + positions.nbytes)
+        table[i]["coefficients_offset"] = offset
+        offset = _align(offset + coefficients.nbytes)
+
+        directivity = b""
+        if mode.get("directivity") is not None:
+            magnitudes = np.ascontiguousarray(mode["directivity"]["magnitudes"], dtype="<f4")
+            directivity = (
+                np.asarray(mode["directivity"]["center"], dtype="<f8").tobytes()
+                + np.asarray(mode["directivity"]["radii"], dtype="<f8").tobytes()
+                + magnitudes.tobytes()
+            )
+            table[i]["directivity_offset"] = offset
+            table[i]["directivity_radii"], table[i]["directivity_theta"], table[i]["directivity_phi"] = magnitudes.shape
+            table[i]["directivity_error"] = mode["directivity"].get("max_error", np.nan)
+            offset = _align(offset + len(directivity))
+        blocks.append((positions, coefficients, directivity))
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header["magic"] = MAGIC
+    header["version"] = VERSION
+    header["mode_count"] = len(modes)
+    header["dtype"] = dtype_code
+    header["alignment"] = ALIGNMENT
+    header["table_offset"] = _align(HEADER_DTYPE.itemsize)
+
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(header.tobytes())
+        f.seek(int(header["table_offset"][0]))
+        f.write(table.tobytes())
+        for (positions, coefficients, directivity), entry in zip(blocks, table):
+            if positions is not None:
+                f.seek(int(entry["positions_offset"]))
+                f.write(positions.tobytes())
+            f.seek(int(entry["coefficients_offset"]))
+            f.write(coefficients.tobytes())
+            if directivity:
+                f.seek(int(entry["directivity_offset"]))
+                f.write(directivity)
+        f.truncate(offset)
+    os.replace(tmp_filename, filename)
+
+def read_header(data):
+    header = data[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+    if header["magic"] != MAGIC.rstrip(b"\0"):
+        raise ValueError("not a PAT bundle")
+    if header["version"] not in SUPPORTED_VERSIONS:
+        raise ValueError(f"unsupported PAT bundle version {header['version']}")
+    table_offset = int(header["table_offset"])
+    table = data[table_offset:table_offset + MODE_DTYPE.itemsize * int(header["mode_count"])].view(MODE_DTYPE)
+    return header, table
+
+def load_bundle(filename):
+    '''map a bundle file, positions and coefficients are read-only views into the mapping
+
+    returns a list of dicts with frequency, k, order, positions (S, 3),
+    coefficients (S * (order + 1)^2,) and directivity, a table for
+    directivity.query_directivity or None
+    '''
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    header, table = read_header(data)
+    position_dtype, coefficient_dtype = PAYLOAD_DTYPES[int(header["dtype"])]
+
+    modes = []
+    for entry in table:
+        source_count = int(entry["source_count"])
+        order = int(entry["order"])
+        positions_offset = int(entry["positions_offset"])
+        coefficients_offset = int(entry["coefficients_offset"])
+        positions_size = source_count * 3 * position_dtype.itemsize
+        coefficients_size = source_count * num_terms(order) * coefficient_dtype.itemsize
+        modes.append({
+            "frequency": float(entry["frequency"]),
+            "k": float(entry["k"]),
+            "order": order,
+            "positions": data[positions_offset:positions_offset + positions_size].view(position_dtype).reshape(source_count, 3),
+            "coefficients": data[coefficients_offset:coefficients_offset + coefficients_size].view(coefficient_dtype),
+            "directivity": read_directivity(data, entry),
+        })
+    return modes
+
+def read_directivity(data, entry):
+    offset = int(entry["directivity_offset"])
+    if offset == 0:
+        return None
+    shape = (int(entry["directivity_radii"]), int(entry["directivity_theta"]), int(entry["directivity_phi"]))
+    magnitudes_offset = offset + 8 * (3 + shape[0])
+    return {
+        "center": data[offset:offset + 24].view("<f8"),
+        "radii": data[offset + 24:magnitudes_offset].view("<f8"),
+        "magnitudes": data[magnitudes_offset:magnitudes_offset + 4 * int(np.prod(shape))].view("<f4").reshape(shape),
+        "max_error": float(entry["directivity_error"]),
+    }
+
+def read_k_file(filename):
+    # (k, order) from a .k file, k is the last double, the order the one before it if
+    # present, files without it hold order 1 sources
+    values = np.fromfile(filename, dtype="<f8")
+    return float(values[-1]), int(values[-2]) if len(values) > 1 else 1
+
+def read_legacy_mode(base, speed_of_sound=343):
+    # one mode from a headerless <base>.sources file of 3 + 2 (order + 1)^2 doubles per source and its <base>.k
+    k, order = read_k_file(f"{base}.k")
+    sources = np.fromfile(f"{base}.sources", dtype="<f8").reshape(-1, 3 + 2 * num_terms(order))
+    return {
+        "frequency": k * speed_of_sound / (2 * np.pi),
+        "k": k,
+        "order": order,
+        "positions": sources[:, :3],
+        "coefficients": (sources[:, 3::2] + 1j * sources[:, 4::2]).ravel(),
+    }
+
+def modes_from_patlist(patlist_filename, speed_of_sound=343):
+    # the modes listed in a PATlist file, paths are relative to the file
+    root = os.path.dirname(os.path.abspath(patlist_filename))
+    with open(patlist_filename) as f:
+        pat_list = [pat for pat in f.read().splitlines() if pat.strip()]
+    return [read_legacy_mode(os.path.join(root, pat), speed_of_sound) for pat in pat_list]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack the modes of a PATlist file into one bundle")
+    parser.add_argument("patlist")
+    parser.add_argument("bundle")
+    parser.add_argument("--float32", action="store_true")
+    parser.add_argument("--directivity", action="store_true", help="bake directivity tables into the bundle")
+    args = parser.parse_args()
+
+    modes = modes_from_patlist(args.patlist)
+    if args.directivity:
+        for mode in modes:
+            mode["directivity"] = bake_directivity(mode["positions"], mode["coefficients"], mode["k"], tolerance=DIRECTIVITY_TOLERANCE)
+    write_bundle(args.bundle, modes, dtype=np.float32 if args.float32 else np.float64)
+    print(f"Exported {args.bundle} with {len(modes)} modes.")
@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import collections
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from evaluate import evaluate_modes, evaluate_tables, group_modes
+from pat_bundle import load_bundle
+from profiling import log, setup_logging
+from synth import ModalSynth, BLOCK_SIZE
+
+# every message is a little endian u32 header length, a JSON header and
+# header["payload_bytes"] bytes of binary payload
+#
+#   requests   {"op": "objects"}
+#              {"op": "stats"}
+#              {"op": "close", "object": "plastic", "stream": "impact-3"}
+#              {"op": "block", "object": "plastic", "listeners": L, "output": "amplitudes" | "pcm",
+#               "stream": "impact-3", "impact": 1.0}, payload (L, 3) float32 listener positions
+#   responses  {"id": ..., "ok": true, ...}, amplitudes (L, modes) float32 or one PCM block
+#              of block_size float32 samples, {"id": ..., "ok": false, "error": "..."} on failure
+#
+# a "block" with output "pcm" renders the next block of the stream (object, stream)
+# at its first listener, "impact" strikes every mode of the stream first, a stream
+# is dropped on "close" or once it has decayed below SILENCE, the next block of a
+# dropped stream starts a silent one
+HEADER_LENGTH = struct.Struct("<I")
+
+DEFAULT_PORT = 7878
+
+# seconds a batch waits for more requests before it is evaluated
+BATCH_WINDOW = 0.0005
+MAX_BATCH = 256
+
+# latencies kept for the percentiles in the stats
+LATENCY_WINDOW = 4096
+
+# phasor magnitude below which a stream without pending impacts has decayed
+SILENCE = 1e-6
+
+async def read_message(reader):
+    header_length, = HEADER_LENGTH.unpack(await reader.readexactly(HEADER_LENGTH.size))
+    header = json.loads(await reader.readexactly(header_length))
+    payload = await reader.readexactly(header.get("payload_bytes", 0))
+    return header, payload
+
+def encode_message(header, payload=b""):
+    header = json.dumps({**header, "payload_bytes": len(payload)}).encode()
+    return HEADER_LENGTH.pack(len(header)) + header + payload
+
+class ServiceStats:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        # block requests evaluated in a batch, other ops and failed batches are not counted
+        self.block_requests = 0
+        self.batches = 0
+        self.listeners = 0
+        self.evaluation_time = 0.0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        latencies = np.array(self.latencies) * 1e3
+        return {
+            "uptime": elapsed,
+            "requests": self.requests,
+            "errors": self.errors,
+            "block_requests": self.block_requests,
+            "batches": self.batches,
+            "listeners": self.listeners,
+            "requests_per_second": self.requests / elapsed,
+            "mean_batch_size": self.block_requests / max(self.batches, 1),
+            "evaluation_ms": 1e3 * self.evaluation_time,
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "max": float(latencies.max()) if len(latencies) else None,
+            },
+        }
+
+class PatObject:
+    '''modes of one bundle, kept resident, and the queue of listeners waiting for them'''
+
+    def __init__(self, name, filename, use_tables=False, dtype=np.float32):
+        self.name = name
+        bundle = load_bundle(filename)
+        self.frequencies = np.array([mode["frequency"] for mode in bundle])
+        self.modes = [(mode["positions"], mode["coefficients"], mode["k"]) for mode in bundle]
+        self.tables = [mode["directivity"] for mode in bundle]
+        self.use_tables = use_tables and all(table is not None for table in self.tables)
+        self.dtype = dtype
+        # modes sharing positions, grouped once instead of on every batch
+        self.groups = group_modes(self.modes)
+        self.queue = asyncio.Queue()
+
+        # summed amplitude 1 m around the sources, synth gains are relative to it
+        # so distance and direction still change the loudness
+        center = np.concatenate([np.asarray(positions).reshape(-1, 3) for positions, _, _ in self.modes]).mean(axis=0)
+        directions = np.random.default_rng(0).normal(size=(64, 3))
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        self.reference = float(np.mean(np.sum(self.evaluate(center + directions), axis=1)))
+
+    def evaluate(self, listeners):
+        # (L, modes) pressure magnitudes
+        if self.use_tables:
+            return evaluate_tables(listeners, self.tables)
+        return evaluate_modes(listeners, self.modes, dtype=self.dtype, groups=self.groups)
+
+class PatService:
+    '''asyncio service evaluating PAT bundles for many clients
+
+    concurrent requests for the same object are coalesced into one vectorized
+    evaluation of all of their listeners, evaluations run in a worker thread
+    so the event loop keeps accepting requests meanwhile
+    '''
+
+    def __init__(self, bundles, use_tables=False, dtype=np.float32, sample_rate=44100,
+                 block_size=BLOCK_SIZE, damping=3.0, batch_window=BATCH_WINDOW):
+        self.objects = {name: PatObject(name, filename, use_tables, dtype) for name, filename in bundles.items()}
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.damping = damping
+        self.batch_window = batch_window
+        # (object, stream) -> ModalSynth
+        self.streams = {}
+        self.stats = ServiceStats()
+        self._batchers = []
+
+    async def start(self, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+        self._batchers = [asyncio.create_task(self._batch(obj)) for obj in self.objects.values()]
+        if unix_path is not None:
+            return await asyncio.start_unix_server(self._handle_connection, unix_path)
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def evaluate(self, name, listeners):
+        # amplitudes at the listeners, evaluated together with other pending requests
+        future = asyncio.get_running_loop().create_future()
+        await self.objects[name].queue.put((listeners, future))
+        return await future
+
+    async def _batch(self, obj):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await obj.queue.get()]
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            while not obj.queue.empty() and len(batch) < MAX_BATCH:
+                batch.append(obj.queue.get_nowait())
+
+            listeners = np.concatenate([listeners for listeners, _ in batch])
+            start = time.perf_counter()
+            try:
+                amplitudes = await loop.run_in_executor(None, obj.evaluate, listeners)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                continue
+            self.stats.evaluation_time += time.perf_counter() - start
+            self.stats.batches += 1
+            self.stats.block_requests += len(batch)
+            self.stats.listeners += len(listeners)
+
+            offset = 0
+            for listeners, future in batch:
+                if not future.cancelled():
+                    future.set_result(amplitudes[offset:offset + len(listeners)])
+                offset += len(listeners)
+
+    def _stream(self, obj, stream):
+        key = (obj.name, stream)
+        if key not in self.streams:
+            self.streams[key] = ModalSynth(obj.frequencies, damping=self.damping,
+                                           sample_rate=self.sample_rate, block_size=self.block_size,
+                                           gains=np.zeros(len(obj.frequencies)))
+        return self.streams[key]
+
+    async def _block(self, header, payload):
+        obj = self.objects[header["object"]]
+        listeners = np.frombuffer(payload, dtype="<f4").reshape(-1, 3).astype(np.float64)
+        amplitudes = await self.evaluate(obj.name, listeners)
+
+        if header.get("output", "amplitudes") == "amplitudes":
+            return {"shape": list(amplitudes.shape)}, np.ascontiguousarray(amplitudes, dtype="<f4").tobytes()
+
+        synth = self._stream(obj, header.get("stream", "default"))
+        if header.get("impact") is not None:
+            synth.strike(header["impact"])
+        synth.set_gains(amplitudes[0] / obj.reference)
+        block = synth.process_block()
+        if synth.idle(SILENCE):
+            del self.streams[(obj.name, header.get("stream", "default"))]
+        return {"samples": self.block_size}, np.asarray(block, dtype="<f4").tobytes()
+
+    async def _respond(self, header, payload, writer):
+        start = time.perf_counter()
+        response = {"id": header.get("id"), "ok": True}
+        response_payload = b""
+        try:
+            op = header.get("op")
+            if op == "block":
+                extra, response_payload = await self._block(header, payload)
+                response.update(extra)
+            elif op == "objects":
+                response["objects"] = {
+                    name: {"frequencies": obj.frequencies.tolist(), "tables": obj.use_tables}
+                    for name, obj in self.objects.items()
+                }
+            elif op == "stats":
+                response["stats"] = self.stats.summary()
+            elif op == "close":
+                response["closed"] = self.streams.pop((header["object"], header.get("stream", "default")), None) is not None
+            else:
+                raise ValueError(f"unknown op {op!r}")
+        except Exception as e:
+            self.stats.errors += 1
+            response = {"id": header.get("id"), "ok": False, "error": repr(e)}
+            response_payload = b""
+
+        self.stats.requests += 1
+        self.stats.latencies.append(time.perf_counter() - start)
+        writer.write(encode_message(response, response_payload))
+        await writer.drain()
+
+    async def _handle_connection(self, reader, writer):
+        # requests of one connection may be pipelined, responses carry their id
+        tasks = set()
+        try:
+            while True:
+                header, payload = await read_message(reader)
+                task = asyncio.create_task(self._respond(header, payload, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+class PatClient:
+    '''asyncio client of PatService, requests may be issued concurrently'''
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._next_id = 0
+        self._pending = {}
+        self._receiver = asyncio.create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=DEFAULT_PORT, unix_path=None):
+        if unix_path is not None:
+            reader, writer = await asyncio.open_unix_connection(unix_path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _receive(self):
+        try:
+            while True:
+                header, payload = await read_message(self.reader)
+                future = self._pending.pop(header["id"], None)
+                if future is not None and not future.cancelled():
+                    future.set_result((header, payload))
+        except (asyncio.IncompleteReadError, ConnectionResetError) as e:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(e))
+
+    async def request(self, header, payload=b""):
+        request_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self.writer.write(encode_message({**header, "id": request_id}, payload))
+        await self.writer.drain()
+
+        header, payload = await future
+        if not header["ok"]:
+            raise RuntimeError(header["error"])
+        return header, payload
+
+    async def amplitudes(self, name, listeners):
+        listeners = np.ascontiguousarray(listeners, dtype="<f4").reshape(-1, 3)
+        header, payload = await self.request({"op": "block", "object": name, "output": "amplitudes"}, listeners.tobytes())
+        return np.frombuffer(payload, dtype="<f4").reshape(header["shape"])
+
+    async def render(self, name, stream, listener, impact=None):
+        # next PCM block of a stream heard at listener, impact strikes it first
+        listener = np.ascontiguousarray(listener, dtype="<f4").reshape(1, 3)
+        header = {"op": "block", "object": name, "output": "pcm", "stream": stream, "impact": impact}
+        _, payload = await self.request(header, listener.tobytes())
+        return np.frombuffer(payload, dtype="<f4")
+
+    async def close_stream(self, name, stream):
+        # drops the stream, returns whether it was still open
+        header, _ = await self.request({"op": "close", "object": name, "stream": stream})
+        return header["closed"]
+
+    async def objects(self):
+        header, _ = await self.request({"op": "objects"})
+        return header["objects"]
+
+    async def stats(self):
+        header, _ = await self.request({"op": "stats"})
+        return header["stats"]
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self._receiver.cancel()
+
+def bundle_arguments(arguments):
+    # name=path.pat or path.pat named after the file
+    bundles = {}
+    for argument in arguments:
+        name, _, filename = argument.rpartition("=")
+        bundles[name or os.path.splitext(os.path.basename(filename))[0]] = filename
+    return bundles
+
+async def serve(args):
+    service = PatService(
+        bundle_arguments(args.bundles),
+        use_tables=args.tables,
+        dtype=np.float64 if args.float64 else np.float32,
+        sample_rate=args.sample_rate,
+        block_size=args.block_size,
+        damping=args.damping,
+    )
+    server = await service.start(args.host, args.port, args.unix)
+    for name, obj in service.objects.items():
+        log.info(f"{name}: {len(obj.modes)} modes{', directivity tables' if obj.use_tables else ''}")
+    log.info(f"Serving on {args.unix or f'{args.host}:{args.port}'}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve PAT bundle evaluations over a local socket")
+    parser.add_argument("bundles", nargs="+", help="bundle files, as name=path.pat or path.pat")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--unix", default=None, help="listen on a unix socket instead")
+    parser.add_argument("--tables", action="store_true", help="evaluate from the baked directivity tables")
+    parser.add_argument("--float64", action="store_true", help="evaluate the multipoles in double precision")
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    parser.add_argument("--damping", type=float, default=3.0)
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+    asyncio.run(serve(args))
@@ -0,0 +1,315 @@
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import profiling
+from profiling import log
+from cache import ArtifactCache, CACHE_DIR, file_key, hash_key
+from geometry import load_mesh_cached, CandidatePool
+from main import load_weights, compute_p_bars, precompute_mode, precompute_joint, output_filenames, export_bundle
+from multipole_util import SKETCH_OVERSAMPLE
+
+# thread pools of numpy's BLAS backends and of numba, one per worker process
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+]
+
+# job fields that can be given once at the top of the manifest
+JOB_DEFAULTS = {
+    "source_number": 32,
+    "candidates_number": 1000,
+    "seed": None,
+    "l_max": 1,
+    "fixed_pool": False,
+    "sketch": None,
+    "joint": False,
+    "sketch_oversample": SKETCH_OVERSAMPLE,
+    "bundle_dtype": "float64",
+    "directivity": True,
+}
+
+def load_manifest(path):
+    '''read a job manifest, relative paths are resolved against its directory
+
+    {
+        "workers": 8, "blas_threads": 1, "source_number": 32, "candidates_number": 1000, "l_max": 1,
+        "jobs": [{
+            "name": "plastic", "membrane": "...obj", "surface": "...obj",
+            "output_dir": "plastic", "patlist": "PATlist_plastic.txt", "bundle": "plastic.pat",
+            "modes": [{"frequency": 43.949, "participation": [61.18, 0, 0]}, ...]
+        }, ...]
+    }
+    '''
+    with open(path) as f:
+        manifest = json.load(f)
+
+    root = os.path.dirname(os.path.abspath(path))
+    for job in manifest["jobs"]:
+        for name, default in JOB_DEFAULTS.items():
+            job.setdefault(name, manifest.get(name, default))
+        job.setdefault("bundle", f"{job['output_dir']}.pat")
+        for name in ("membrane", "surface", "output_dir", "patlist", "bundle"):
+            job[name] = os.path.join(root, job[name])
+    return manifest
+
+def active_modes(job):
+    # modes without participation produce no sound and are not precomputed
+    return [mode for mode in job["modes"] if np.linalg.norm(mode["participation"]) >= 1e-6]
+
+# job fields the exported sources of a mode depend on
+MODE_PARAMS = ["source_number", "candidates_number", "seed", "l_max", "fixed_pool", "sketch", "joint", "sketch_oversample"]
+
+def marker_filename(job, mode):
+    return os.path.join(job["output_dir"], f"{mode['frequency']:.0f}.done")
+
+def mode_key(job, mode):
+    # hash of the meshes, job parameters and p_bar inputs a mode was computed from,
+    # joint modes share their positions so they depend on every mode of the job
+    modes = active_modes(job) if job["joint"] else [mode]
+    return hash_key(
+        *[np.asarray(m["participation"], dtype=np.float64) for m in modes],
+        frequencies=np.array([m["frequency"] for m in modes], dtype=np.float64),
+        membrane=file_key(job["membrane"]),
+        surface=file_key(job["surface"]),
+        params=json.dumps({name: job[name] for name in MODE_PARAMS}, sort_keys=True)
+    )
+
+def outputs_exist(job, mode):
+    return all(os.path.exists(filename) for filename in output_filenames(mode["frequency"], job["output_dir"]))
+
+def mode_done(job, mode):
+    # outputs only count when their marker matches the current inputs
+    if not outputs_exist(job, mode) or not os.path.exists(marker_filename(job, mode)):
+        return False
+    with open(marker_filename(job, mode)) as f:
+        return f.read().strip() == mode_key(job, mode)
+
+def mark_done(job, modes):
+    for mode in modes:
+        with open(marker_filename(job, mode), "w") as f:
+            f.write(mode_key(job, mode))
+
+def check_done(job, mode):
+    # like mode_done, logs outputs of an earlier run that are recomputed
+    if mode_done(job, mode):
+        return True
+    if outputs_exist(job, mode):
+        log.info(f"[{task_name(job, mode)}] outputs do not match the job parameters, recomputing")
+    return False
+
+def write_patlist(job):
+    # one line per exported mode, relative to the PATlist file
+    patlist_dir = os.path.dirname(job["patlist"])
+    lines = [
+        os.path.relpath(os.path.join(job["output_dir"], f"{mode['frequency']:.0f}"), patlist_dir)
+        for mode in job["modes"]
+        if mode_done(job, mode)
+    ]
+    with open(job["patlist"], "w") as f:
+        f.write("\n".join(lines))
+    return len(lines)
+
+# meshes, weights and cache of a worker process, loaded on its first task
+_worker_state = {}
+
+def _load_job_inputs(job, cache_dir, use_cache):
+    key = (job["membrane"], job["surface"])
+    if key not in _worker_state:
+        cache = ArtifactCache(cache_dir, enabled=use_cache)
+        membrane, surface = load_mesh_cached(job["membrane"], job["surface"], cache)
+        W, sample_points = load_weights(surface, cache)
+        _worker_state[key] = (cache, membrane, surface, W, np.asarray(sample_points))
+    return _worker_state[key]
+
+def task_name(job, mode):
+    # a task is one mode, or every mode of a joint job when mode is None
+    return f"{job['name']}_joint" if mode is None else f"{job['name']}_{mode['frequency']:.0f}"
+
+def mode_inputs(mode):
+    return {"frequency": mode["frequency"], "participation": np.asarray(mode["participation"], dtype=np.float64)}
+
+def task_modes(job, mode):
+    return [mode_inputs(mode) for mode in active_modes(job)] if mode is None else [mode_inputs(mode)]
+
+def solve_p_bars(tasks, cache_dir, use_cache):
+    '''p_bars of every task, solved before the tasks are fanned out to the workers
+
+    tasks on the same surface mesh share one BEM session and one warm-started
+    sweep over all of their frequencies, so materials of the same object reuse
+    the assembled grid and seed each other's solves, cached p_bars are not solved
+    '''
+    groups = {}
+    for i, (job, mode) in enumerate(tasks):
+        groups.setdefault(job["surface"], []).append(i)
+
+    p_bars = {}
+    for surface_path, indices in groups.items():
+        modes = {i: task_modes(*tasks[i]) for i in indices}
+        try:
+            cache, _, surface, _, sample_points = _load_job_inputs(tasks[indices[0]][0], cache_dir, use_cache)
+            solved = iter(compute_p_bars(surface, sample_points, [mode for i in indices for mode in modes[i]], cache))
+        except Exception as e:
+            # the tasks of this surface fail, the others still run
+            log.error(f"[{surface_path}] BEM solve failed: {e!r}")
+            continue
+        for i in indices:
+            p_bars[i] = [next(solved) for _ in modes[i]]
+    return p_bars
+
+def run_mode(job, mode, p_bars, cache_dir, use_cache, log_level="INFO", trace_dir=None):
+    # spawned workers start with default logging, a trace is written per task
+    profiling.setup_logging(log_level)
+    if trace_dir is not None:
+        profiling.enable()
+    try:
+        if mode is None:
+            return _run_joint(job, p_bars, cache_dir, use_cache)
+        return _run_mode(job, mode, p_bars[0], cache_dir, use_cache)
+    finally:
+        if trace_dir is not None:
+            profiling.disable().write(os.path.join(trace_dir, f"{task_name(job, mode)}.json"))
+
+def _run_mode(job, mode, p_bar_val, cache_dir, use_cache):
+    start_time = time.perf_counter()
+    cache, membrane, surface, W, sample_points = _load_job_inputs(job, cache_dir, use_cache)
+
+    candidate_pool = CandidatePool(membrane, job["candidates_number"], seed=job["seed"])
+    precompute_mode(
+        membrane=membrane,
+        W=W,
+        sample_points=sample_points,
+        frequency=mode["frequency"],
+        p_bar_val=p_bar_val,
+        source_number=job["source_number"],
+        candidates_number=job["candidates_number"],
+        candidate_pool=candidate_pool,
+        output_dir=job["output_dir"],
+        l_max=job["l_max"],
+        fixed_pool=job["fixed_pool"],
+        sketch=job["sketch"],
+        sketch_oversample=job["sketch_oversample"],
+        seed=job["seed"]
+    )
+    mark_done(job, [mode])
+    return time.perf_counter() - start_time
+
+def _run_joint(job, p_bars, cache_dir, use_cache):
+    # shared positions, every mode of the job is placed again
+    start_time = time.perf_counter()
+    cache, membrane, surface, W, sample_points = _load_job_inputs(job, cache_dir, use_cache)
+
+    candidate_pool = CandidatePool(membrane, job["candidates_number"], seed=job["seed"])
+    precompute_joint(
+        membrane=membrane,
+        W=W,
+        sample_points=sample_points,
+        modes=task_modes(job, None),
+        p_bars=p_bars,
+        source_number=job["source_number"],
+        candidates_number=job["candidates_number"],
+        candidate_pool=candidate_pool,
+        output_dir=job["output_dir"],
+        l_max=job["l_max"],
+        fixed_pool=job["fixed_pool"],
+        sketch=job["sketch"],
+        sketch_oversample=job["sketch_oversample"],
+        seed=job["seed"]
+    )
+    mark_done(job, active_modes(job))
+    return time.perf_counter() - start_time
+
+def run_pipeline(manifest, workers=None, blas_threads=1, cache_dir=CACHE_DIR, use_cache=True, log_level="INFO", trace_dir=None):
+    # checkpointed modes from an earlier run are skipped
+    tasks = []
+    for job in manifest["jobs"]:
+        if job["joint"]:
+            if all([check_done(job, mode) for mode in active_modes(job)]):
+                log.info(f"[{job['name']}] already done, skipping")
+            else:
+                tasks.append((job, None))
+            continue
+        for mode in active_modes(job):
+            if check_done(job, mode):
+                log.info(f"[{job['name']}] {mode['frequency']} already done, skipping")
+                continue
+            tasks.append((job, mode))
+
+    if trace_dir is not None:
+        os.makedirs(trace_dir, exist_ok=True)
+        profiling.enable()
+    
+    # the BEM solves run here, the workers only place sources and fit coefficients
+    try:
+        p_bars = solve_p_bars(tasks, cache_dir, use_cache)
+    finally:
+        if trace_dir is not None:
+            profiling.disable().write(os.path.join(trace_dir, "bem.json"))
+    
+    # set before the workers start so their BLAS libraries pick it up on import
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(blas_threads)
+    workers = workers or max(1, (os.cpu_count() or 1) // blas_threads)
+
+    log.info(f"{len(tasks)} tasks to precompute on {workers} workers")
+    failed = [(job, mode) for i, (job, mode) in enumerate(tasks) if i not in p_bars]
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {
+            executor.submit(run_mode, job, mode, p_bars[i], cache_dir, use_cache, log_level, trace_dir): (job, mode)
+            for i, (job, mode) in enumerate(tasks)
+            if i in p_bars
+        }
+        for future in as_completed(futures):
+            job, mode = futures[future]
+            try:
+                elapsed = future.result()
+                log.info(f"[{task_name(job, mode)}] done in {elapsed:.1f} s")
+            except Exception as e:
+                log.error(f"[{task_name(job, mode)}] failed: {e!r}")
+                failed.append((job, mode))
+
+    for job in manifest["jobs"]:
+        count = write_patlist(job)
+        log.info(f"[{job['name']}] wrote {job['patlist']} with {count} modes")
+        
+        # the bundle is only written once every mode of the object is done
+        modes = active_modes(job)
+        if all(mode_done(job, mode) for mode in modes):
+            export_bundle(job["bundle"], [mode["frequency"] for mode in modes], job["output_dir"], job["bundle_dtype"], job["directivity"])
+
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute every mode of every job in a manifest")
+    parser.add_argument("manifest", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "precompute.json"))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--blas-threads", type=int, default=None)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--trace", default=None, metavar="DIR", help="write a chrome trace of every mode to DIR")
+    args = parser.parse_args()
+    profiling.setup_logging(args.log_level)
+
+    manifest = load_manifest(args.manifest)
+    failed = run_pipeline(
+        manifest,
+        workers=args.workers or manifest.get("workers"),
+        blas_threads=args.blas_threads or manifest.get("blas_threads", 1),
+        cache_dir=args.cache_dir,
+        use_cache=not args.no_cache,
+        log_level=args.log_level,
+        trace_dir=args.trace
+    )
+    if failed:
+        raise SystemExit(f"{len(failed)} tasks failed, rerun to retry them")
@@ -0,0 +1,134 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+# every module logs through this logger, main.py and pipeline.py set its level
+log = logging.getLogger("precomp")
+
+# profile of the current run, None when profiling is disabled
+_profile = None
+
+# returned by stage() when disabled, entering it does nothing
+_NULL_STAGE = contextlib.nullcontext()
+
+def setup_logging(level="INFO"):
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s", datefmt="%H:%M:%S")
+    log.setLevel(level.upper() if isinstance(level, str) else level)
+
+class Profile:
+    '''wall time, call count and peak memory per stage, counters and value series
+
+    stages nest, each one is also kept as a complete event for the chrome trace
+    '''
+
+    def __init__(self, trace_memory=True):
+        self.start_time = time.perf_counter()
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.counters = {}
+        self.series = {}
+        self.events = []
+        # running peak of every open stage, innermost last
+        self._peaks = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _memory_peak(self):
+        # peak since the last reset, folded into every open stage before resetting
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for i in range(len(self._peaks)):
+            self._peaks[i] = max(self._peaks[i], peak)
+        return peak
+
+    @contextlib.contextmanager
+    def stage(self, name, **args):
+        if self.trace_memory:
+            self._memory_peak()
+            self._peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            peak = 0
+            if self.trace_memory:
+                self._memory_peak()
+                peak = self._peaks.pop()
+
+            stage = self.stages.setdefault(name, {"calls": 0, "time": 0.0, "peak_memory": 0})
+            stage["calls"] += 1
+            stage["time"] += duration
+            stage["peak_memory"] = max(stage["peak_memory"], peak)
+            self.events.append((name, start - self.start_time, duration, threading.get_ident(), args))
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, value):
+        self.series.setdefault(name, []).append(value)
+
+    def summary(self):
+        return {"stages": self.stages, "counters": self.counters, "series": self.series}
+
+    def trace_events(self):
+        # chrome trace complete events, timestamps in microseconds
+        pid = os.getpid()
+        return [
+            {"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": pid, "tid": tid, "args": args}
+            for name, start, duration, tid, args in self.events
+        ]
+
+    def write(self, filename):
+        # a chrome trace (chrome://tracing, perfetto) that also carries the summary
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms", **self.summary()}, f, indent=1, default=float)
+
+def enable(trace_memory=True):
+    global _profile
+    _profile = Profile(trace_memory)
+    return _profile
+
+def disable():
+    # stops profiling and returns the finished profile
+    global _profile
+    profile, _profile = _profile, None
+    if profile is not None and profile.trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profile
+
+def enabled():
+    return _profile is not None
+
+def stage(name, **args):
+    # with stage("bem.gmres"): ...
+    if _profile is None:
+        return _NULL_STAGE
+    return _profile.stage(name, **args)
+
+def profiled(name=None):
+    # decorator, the whole call is one stage named after the function by default
+    def decorator(func):
+        stage_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profile is None:
+                return func(*args, **kwargs)
+            with _profile.stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    if _profile is not None:
+        _profile.count(name, value)
+
+def record(name, value):
+    if _profile is not None:
+        _profile.record(name, value)
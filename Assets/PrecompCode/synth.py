@@ -0,0 +1,86 @@
+import numpy as np
+
+BLOCK_SIZE = 512
+
+class ModalSynth:
+    '''streaming modal synthesizer, one damped complex oscillator per mode
+
+    each mode is a phasor rotated by exp((-damping + i omega) / sample_rate) per
+    sample, a block is the phasors times a precomputed table of rotation powers,
+    so every block costs O(modes x block_size) and memory does not depend on
+    the rendered duration
+    '''
+
+    def __init__(self, frequencies, damping=0.0, sample_rate=44100, block_size=BLOCK_SIZE,
+                 gains=None, limiter_threshold=0.9, limiter_release=0.05):
+        frequencies = np.asarray(frequencies, dtype=np.float64)
+        damping = np.broadcast_to(np.asarray(damping, dtype=np.float64), frequencies.shape)
+
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.rotation = np.exp((-damping + 2j * np.pi * frequencies) / sample_rate)
+        # rotation^n for n = 0 .. block_size, shared by every block
+        self.powers = self.rotation[:, None] ** np.arange(block_size + 1)
+
+        self.state = np.zeros(len(frequencies), dtype=np.complex128)
+        self.gains = np.ones(len(frequencies)) if gains is None else np.asarray(gains, dtype=np.float64)
+        self._target_gains = self.gains
+        self._events = []
+
+        # peak limiter, instant attack and exponential release
+        self.limiter_threshold = limiter_threshold
+        self.limiter_gain = 1.0
+        self._release = np.exp(-block_size / (limiter_release * sample_rate))
+
+    def strike(self, amplitudes=1.0, offset=0):
+        # impulse of the given amplitude per mode, offset samples into the next block
+        if not 0 <= offset < self.block_size:
+            raise ValueError(f"offset {offset} outside of a block of {self.block_size} samples")
+        self._events.append((offset, np.broadcast_to(np.asarray(amplitudes, dtype=np.float64), self.state.shape)))
+
+    def set_gains(self, gains):
+        # per-mode amplitude at the listener, ramped in over the next block
+        self._target_gains = np.asarray(gains, dtype=np.float64)
+
+    def idle(self, threshold):
+        # no pending impulse and every phasor decayed below threshold
+        return not self._events and np.max(np.abs(self.state), initial=0.0) < threshold
+
+    def process_block(self):
+        B = self.block_size
+
+        # free response of the current phasors plus the impulses of this block
+        osc = self.state[:, None] * self.powers[:, :B]
+        for offset, amplitudes in self._events:
+            osc[:, offset:] += amplitudes[:, None] * self.powers[:, :B - offset]
+        self._events.clear()
+        self.state = osc[:, -1] * self.rotation
+
+        # sum_m (g_m + ramp_n * dg_m) * osc_mn, gains move linearly across the block
+        ramp = np.arange(B) / B
+        signal = osc.imag
+        block = self.gains @ signal + ramp * ((self._target_gains - self.gains) @ signal)
+        self.gains = self._target_gains
+
+        return self._limit(block)
+
+    def _limit(self, block):
+        peak = np.max(np.abs(block))
+        target = min(1.0, self.limiter_threshold / peak) if peak > 0 else 1.0
+
+        if target < self.limiter_gain:
+            # attack over the whole block, the block never exceeds the threshold
+            self.limiter_gain = target
+            return block * target
+
+        gain = target + (self.limiter_gain - target) * self._release
+        block = block * np.linspace(self.limiter_gain, gain, len(block), endpoint=False)
+        self.limiter_gain = gain
+        return block
+
+    def blocks(self, num_blocks=None):
+        # yields blocks until num_blocks, strike and set_gains may be called in between
+        count = 0
+        while num_blocks is None or count < num_blocks:
+            yield self.process_block()
+            count += 1
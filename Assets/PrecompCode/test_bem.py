@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("bempp.api")
+trimesh = pytest.importorskip("trimesh")
+
+from bem import BemSession, p_bar
+
+FREQUENCY = 500.0
+
+@pytest.fixture
+def small_mesh():
+    mesh = trimesh.creation.icosphere(subdivisions=1, radius=0.1)
+    sample_points = 0.3 * mesh.vertices / np.linalg.norm(mesh.vertices, axis=1, keepdims=True)
+    return mesh, sample_points.T
+
+def test_session_solve(small_mesh):
+    mesh, sample_points = small_mesh
+    session = BemSession(mesh, sample_points)
+    assert session.assembler != "fmm"
+    assert session.potential_assembler == "dense"
+
+    fields = session.solve(FREQUENCY)
+    assert fields.shape == (3, sample_points.shape[1])
+    assert np.all(np.isfinite(fields))
+
+    # a mode is the combination of the axis fields, as the direct solve computes it
+    participation = np.array([0.2, -0.5, 1.0])
+    expected = p_bar(mesh, sample_points, FREQUENCY, participation)
+    assert np.allclose(session.p_bar(FREQUENCY, participation), expected, rtol=1e-3, atol=1e-3 * np.abs(expected).max())
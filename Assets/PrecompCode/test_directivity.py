@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from directivity import bake_directivity, query_directivity, grid_directions
+from multipole_util import multipole_pressure
+
+@pytest.fixture
+def mode():
+    rng = np.random.default_rng(11)
+    positions = 0.03 * rng.normal(size=(4, 3))
+    coefficients = rng.normal(size=16) + 1j * rng.normal(size=16)
+    return positions, coefficients, 2 * np.pi * 600.0 / 343
+
+def test_table_nodes_are_exact(mode):
+    positions, coefficients, k = mode
+    table = bake_directivity(positions, coefficients, k, num_theta=9, num_phi=16)
+    # grid directions on a shell, away from the poles
+    radius = table["radii"][2]
+    listeners = table["center"] + radius * grid_directions(9, 16)[1:-1].reshape(-1, 3)
+    exact = np.abs(multipole_pressure(listeners, positions, coefficients, k))
+    assert np.allclose(query_directivity(table, listeners), exact, rtol=1e-5)
+
+def test_refined_table_meets_tolerance(mode):
+    positions, coefficients, k = mode
+    table = bake_directivity(positions, coefficients, k, tolerance=0.05)
+    assert table["max_error"] <= 0.05
+
+    rng = np.random.default_rng(12)
+    directions = rng.normal(size=(300, 3))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    listeners = table["center"] + rng.uniform(table["radii"][0], table["radii"][-1], size=(300, 1)) * directions
+    exact = np.abs(multipole_pressure(listeners, positions, coefficients, k))
+    assert np.max(np.abs(query_directivity(table, listeners) - exact)) / exact.max() < 0.1
+
+def test_far_field_decay(mode):
+    positions, coefficients, k = mode
+    table = bake_directivity(positions, coefficients, k)
+    direction = np.array([0.6, 0.0, 0.8])
+    outer = table["radii"][-1]
+    near, far = query_directivity(table, table["center"] + np.outer([outer, 4 * outer], direction))
+    assert np.isclose(far, near / 4)
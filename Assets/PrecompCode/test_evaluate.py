@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from evaluate import evaluate_dipoles, evaluate_modes, evaluate_pressures, group_modes
+from multipole_util import multipole_basis_k
+
+@pytest.fixture
+def modes():
+    rng = np.random.default_rng(4)
+    shared = 0.05 * rng.normal(size=(6, 3))
+    modes = []
+    for k in (3.0, 7.5, 11.0):
+        modes.append((shared, rng.normal(size=24) + 1j * rng.normal(size=24), k))
+    # a mode with its own positions
+    modes.append((0.05 * rng.normal(size=(4, 3)), rng.normal(size=16) + 1j * rng.normal(size=16), 5.0))
+    return modes
+
+@pytest.fixture
+def listeners():
+    rng = np.random.default_rng(5)
+    return rng.normal(size=(50, 3))
+
+def reference(listeners, modes):
+    return np.stack([np.abs(multipole_basis_k(listeners, positions, k) @ c) for positions, c, k in modes], axis=1)
+
+def test_modes_match_basis(modes, listeners):
+    expected = reference(listeners, modes)
+    pressures = evaluate_modes(listeners, modes)
+    assert pressures.shape == (50, 4)
+    assert np.allclose(pressures, expected, rtol=1e-12, atol=1e-12 * expected.max())
+
+def test_shared_positions_are_grouped(modes):
+    assert sorted(map(sorted, group_modes(modes))) == [[0, 1, 2], [3]]
+
+def test_legacy_source_rows(modes, listeners):
+    # (x, y, z, Re, Im, ...) rows as stored in the .sources files
+    legacy = []
+    for positions, c, k in modes:
+        c = c.reshape(len(positions), -1)
+        rows = np.empty((len(positions), 3 + 2 * c.shape[1]))
+        rows[:, :3] = positions
+        rows[:, 3::2] = c.real
+        rows[:, 4::2] = c.imag
+        legacy.append((rows, k))
+    assert np.allclose(evaluate_pressures(listeners, legacy), evaluate_modes(listeners, modes))
+
+def test_single_precision(modes, listeners):
+    expected = reference(listeners, modes)
+    pressures = evaluate_modes(listeners, modes, dtype=np.float32)
+    assert pressures.dtype == np.float32
+    assert np.max(np.abs(pressures - expected)) / expected.max() < 1e-4
+
+@pytest.mark.parametrize("l_max", [1, 2])
+def test_on_axis_listeners(l_max):
+    # listeners straight above and below a source, where phi is undefined
+    rng = np.random.default_rng(6)
+    positions = np.array([[0.01, -0.02, 0.03], [0.04, 0.0, -0.01]])
+    T = (l_max + 1) ** 2
+    c = rng.normal(size=2 * T) + 1j * rng.normal(size=2 * T)
+    k = 6.0
+    listeners = np.array([
+        [0.01, -0.02, 0.8],
+        [0.01, -0.02, -0.5],
+        [0.04, 0.0, 1.2],
+        [0.04, 0.0, -0.9],
+    ])
+    expected = np.abs(multipole_basis_k(listeners, positions, k, l_max=l_max) @ c)
+    assert np.all(np.isfinite(expected))
+    assert np.allclose(evaluate_modes(listeners, [(positions, c, k)])[:, 0], expected, rtol=1e-12)
+
+    rows = np.empty((2, 3 + 2 * T))
+    rows[:, :3] = positions
+    rows[:, 3::2] = c.reshape(2, T).real
+    rows[:, 4::2] = c.reshape(2, T).imag
+    for listener, p in zip(listeners, expected):
+        assert np.isclose(evaluate_dipoles(listener, rows, k), p, rtol=1e-12)
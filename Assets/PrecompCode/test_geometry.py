@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import trimesh
+
+from cache import ArtifactCache
+from geometry import init_weight_mat, vertex_areas, generate_candidate_points, CandidatePool
+from geometry import MeshArtifacts, load_mesh_artifacts
+from multipole_util import apply_weight
+
+@pytest.fixture
+def sphere():
+    return trimesh.creation.icosphere(subdivisions=2, radius=0.1)
+
+def test_weights_match_face_loop(sphere):
+    # the original per-face loop over a third of every face area
+    expected = np.zeros(len(sphere.vertices))
+    for area, face in zip(sphere.area_faces, sphere.faces):
+        expected[face] += area / 3.0
+
+    W, sample_points = init_weight_mat(sphere)
+    assert W.shape == (len(sphere.vertices),)
+    assert np.allclose(W**2, expected)
+    assert np.isclose(vertex_areas(sphere).sum(), sphere.area)
+    assert np.array_equal(init_weight_mat(sphere, dense=True)[0], np.diag(W))
+
+def test_weight_vector_matches_dense(sphere):
+    W, _ = init_weight_mat(sphere)
+    A = np.random.default_rng(9).normal(size=(len(W), 7)) + 1j
+    assert np.allclose(apply_weight(W, A), np.diag(W) @ A)
+    assert np.allclose(apply_weight(np.diag(W), A), np.diag(W) @ A)
+
+def test_candidate_count_and_containment(sphere):
+    points = generate_candidate_points(sphere, 500, seed=0)
+    assert points.shape == (500, 3)
+    assert sphere.contains(points).all()
+    assert np.array_equal(points, generate_candidate_points(sphere, 500, seed=0))
+
+def test_candidates_in_thin_shell():
+    # most of the bounding box is outside a thin cylinder
+    shell = trimesh.creation.cylinder(radius=0.1, height=0.002)
+    points = generate_candidate_points(shell, 200, seed=1)
+    assert points.shape == (200, 3)
+    assert shell.contains(points).all()
+
+def test_pool_refresh(sphere):
+    pool = CandidatePool(sphere, 400, seed=2)
+    before = pool.points.copy()
+    points = pool.refresh(0.25)
+    assert points is pool.points
+    assert np.sum(np.any(points != before, axis=1)) == 100
+    assert sphere.contains(points).all()
+
+def test_mesh_artifacts_containment():
+    # a torus has an inside region, an outside region and a hole through it
+    mesh = trimesh.creation.torus(major_radius=0.1, minor_radius=0.03)
+    artifacts = MeshArtifacts.from_mesh(mesh, resolution=32)
+    points = np.random.default_rng(15).uniform(*mesh.bounds * 1.2, size=(4000, 3))
+    assert np.array_equal(artifacts.contains(points), mesh.contains(points))
+    assert np.isclose(artifacts.vertex_weights.sum(), mesh.area)
+
+def test_mesh_artifacts_cache(tmp_path, sphere):
+    path = tmp_path / "sphere.obj"
+    sphere.export(path)
+    cache = ArtifactCache(tmp_path / "cache")
+    built = load_mesh_artifacts(str(path), cache)
+    loaded = load_mesh_artifacts(str(path), cache)
+
+    # the second load comes from the cache, without a trimesh mesh
+    assert loaded._mesh is None
+    for name, array in built.arrays().items():
+        assert np.array_equal(loaded.arrays()[name], array)
+    points = generate_candidate_points(loaded, 200, seed=3)
+    assert sphere.contains(points).all()
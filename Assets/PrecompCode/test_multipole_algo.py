@@ -0,0 +1,108 @@
+import types
+import weakref
+
+import numpy as np
+import pytest
+
+import multipole_algo
+from multipole_algo import pick_multipole, candidate_scores, ProjectedCandidates, multipole_placement
+from multipole_util import multipole_basis_func, apply_weight, OrthoBasis
+
+FREQUENCY = 400.0
+
+@pytest.fixture
+def problem():
+    rng = np.random.default_rng(1)
+    sample_points = rng.normal(size=(120, 3))
+    sample_points /= np.linalg.norm(sample_points, axis=1, keepdims=True)
+    weight = np.sqrt(rng.uniform(0.5, 1.5, size=len(sample_points)))
+    candidates = 0.3 * rng.normal(size=(150, 3))
+
+    # residual of a single known source, so one candidate clearly wins
+    true_source = candidates[37]
+    p_bar = multipole_basis_func(true_source, sample_points, FREQUENCY) @ np.array([1.0, 0.5j, -0.2, 0.3])
+    residual = apply_weight(weight, p_bar)
+    return residual / np.linalg.norm(residual), candidates, sample_points, weight
+
+def loop_scores(residual, candidates, sample_points, weight):
+    scores = []
+    for candidate in candidates:
+        U, _ = np.linalg.qr(apply_weight(weight, multipole_basis_func(candidate, sample_points, FREQUENCY)))
+        scores.append(np.linalg.norm(U.conj().T @ residual))
+    return np.array(scores)
+
+def test_block_scores_match_loop(problem):
+    residual, candidates, sample_points, weight = problem
+    expected = loop_scores(residual, candidates, sample_points, weight)
+    for block_size in (1, 16, 64, 1000):
+        scores = candidate_scores(residual, candidates, sample_points, weight, multipole_basis_func, FREQUENCY, block_size)
+        assert np.allclose(scores, expected, rtol=1e-10, atol=1e-12)
+
+def test_block_pick_matches_loop(problem):
+    residual, candidates, sample_points, weight = problem
+    blocked = pick_multipole(residual, candidates, sample_points, weight, multipole_basis_func, FREQUENCY)
+    looped = pick_multipole(residual, candidates, sample_points, weight, multipole_basis_func, FREQUENCY, block_size=None)
+    assert np.array_equal(blocked, looped)
+    assert np.array_equal(blocked, candidates[37])
+
+def test_column_residual(problem):
+    # main passes the residual as an (N, 1) column
+    residual, candidates, sample_points, weight = problem
+    scores = candidate_scores(residual[:, None], candidates, sample_points, weight, multipole_basis_func, FREQUENCY)
+    assert np.allclose(scores, candidate_scores(residual, candidates, sample_points, weight, multipole_basis_func, FREQUENCY))
+
+def test_projected_scores_follow_residual(problem, monkeypatch):
+    # downdated gram matrices score like a fresh QR of the projected candidate bases
+    residual, candidates, sample_points, weight = problem
+    residual = residual.copy()
+    Q = OrthoBasis(len(residual), 12)
+
+    # weighted candidate blocks still alive whenever the next one is evaluated
+    blocks, live = [], []
+    def tracked_weight(weight, A):
+        live.append(sum(block() is not None for block in blocks))
+        WA = apply_weight(weight, A)
+        blocks.append(weakref.ref(WA))
+        return WA
+    monkeypatch.setattr(multipole_algo, "apply_weight", tracked_weight)
+
+    # spill_bytes=0 keeps the stack in a memory-mapped file
+    with ProjectedCandidates(candidates, sample_points, weight, multipole_basis_func, FREQUENCY, residual,
+                             block_size=16, spill_bytes=0) as projected:
+        assert len(blocks) == 10 and max(live) == 0
+        for index in (3, 90, 37):
+            Q_new = Q.append(apply_weight(weight, multipole_basis_func(candidates[index], sample_points, FREQUENCY)))
+            # the candidates are downdated with the residual before the new columns are projected out
+            projected.update(Q_new, residual)
+            residual -= Q_new @ (Q_new.conj().T @ residual)
+
+            A = apply_weight(weight, multipole_basis_func(candidates, sample_points, FREQUENCY))
+            B = A - Q.Q @ (Q.Q.conj().T @ A)
+            expected = []
+            for a, b in zip(np.split(A, len(candidates), axis=1), np.split(B, len(candidates), axis=1)):
+                # directions of b that are not already spanned by Q
+                U, sigma, _ = np.linalg.svd(b, full_matrices=False)
+                U = U[:, sigma**2 > multipole_algo.EIG_CUTOFF * np.linalg.norm(a, 2)**2]
+                expected.append(np.linalg.norm(U.conj().T @ residual))
+            assert np.allclose(projected.scores(), expected, atol=1e-6)
+    assert projected._spill_file is None
+
+def test_placement_releases_candidates_on_error(problem, monkeypatch):
+    residual, candidates, sample_points, weight = problem
+    closed = []
+    monkeypatch.setattr(ProjectedCandidates, "close", lambda self: closed.append(self))
+    def fail(*args):
+        raise RuntimeError("update failed")
+    monkeypatch.setattr(multipole_algo, "expand_subspace_and_update_residual", fail)
+
+    pool = types.SimpleNamespace(points=candidates)
+    with pytest.raises(RuntimeError):
+        multipole_placement(1e-6, weight, residual[:, None], None, sample_points, FREQUENCY, 4, len(candidates),
+                            multipole_basis_func, candidate_pool=pool, fixed_pool=True)
+    assert len(closed) == 1
+
+def test_projected_without_candidates(problem):
+    residual, candidates, sample_points, weight = problem
+    with ProjectedCandidates(candidates[:0], sample_points, weight, multipole_basis_func, FREQUENCY, residual) as projected:
+        assert projected.scores().shape == (0,)
+        projected.update(np.eye(len(residual), 4), residual)
@@ -0,0 +1,163 @@
+import numpy as np
+import pytest
+
+from multipole_util import (
+    multipole_basis, multipole_basis_func, fin_multipole, psi_val, spherical_coords, lm_pairs,
+    compute_coefficient, apply_weight, OrthoBasis,
+    multipole_basis_k, multipole_pressures, num_terms, order_from_terms,
+    sketch_rows, leverage_scores, weighted_residual,
+)
+
+SPEED_OF_SOUND = 343
+
+def scalar_basis(sample_points, sources, k, l_max=1):
+    # the original per point, per source psi_val evaluation
+    pairs = lm_pairs(l_max)
+    V = np.zeros((len(sample_points), len(sources) * len(pairs)), dtype=np.complex128)
+    for i, sample in enumerate(sample_points):
+        for j, source in enumerate(sources):
+            r, theta, phi = spherical_coords(sample, source)
+            for t, (l, m) in enumerate(pairs):
+                V[i, j * len(pairs) + t] = psi_val(l, m, k, r, theta, phi)
+    return V
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    return rng.normal(size=(40, 3)), 0.1 * rng.normal(size=(5, 3))
+
+def relative_error(a, b):
+    return np.max(np.abs(a - b)) / np.max(np.abs(b))
+
+def test_basis_matches_scalar_path(points):
+    sample_points, sources = points
+    frequency = 183.9
+    k = 2 * np.pi * frequency / SPEED_OF_SOUND
+
+    V = multipole_basis(sample_points, sources, frequency)
+    assert V.shape == (40, 4 * 5)
+    assert relative_error(V, scalar_basis(sample_points, sources, k)) < 1e-12
+
+def test_basis_chunking(points):
+    sample_points, sources = points
+    V = multipole_basis(sample_points, sources, 500.0)
+    assert np.allclose(multipole_basis(sample_points, sources, 500.0, chunk_size=7), V, rtol=0, atol=1e-14)
+
+def test_basis_func_single_source(points):
+    sample_points, sources = points
+    V = multipole_basis(sample_points, sources, 300.0)
+    assert np.array_equal(multipole_basis_func(sources[2], sample_points, 300.0), V[:, 8:12])
+
+def test_fin_multipole_uses_wavenumber(points):
+    # the lm loop used to shadow k, so every column was evaluated at the loop index
+    sample_points, sources = points
+    frequency = 700.0
+    k = 2 * np.pi * frequency / SPEED_OF_SOUND
+
+    V = fin_multipole(sample_points, sources, frequency)
+    assert relative_error(V, scalar_basis(sample_points, sources, k)) < 1e-12
+    assert relative_error(V, scalar_basis(sample_points, sources, 2 * np.pi * frequency)) > 1e-3
+
+def test_coefficients_from_factorization(points):
+    # c = R^-1 Q^H W p_bar from the placement QR equals the pseudoinverse solve
+    sample_points, sources = points
+    frequency = 250.0
+    weight = np.sqrt(np.random.default_rng(2).uniform(0.5, 1.5, size=len(sample_points)))
+    c_true = np.random.default_rng(3).normal(size=4 * len(sources)) * (1 + 1j)
+    V = multipole_basis(sample_points, sources, frequency)
+    p_bar = V @ c_true
+
+    Q = OrthoBasis(len(sample_points), 4)
+    for j in range(len(sources)):
+        Q.append(apply_weight(weight, V[:, 4 * j:4 * j + 4]))
+
+    c_qr = compute_coefficient(weight, sources, p_bar, sample_points, frequency, factorization=Q)
+    c_svd = compute_coefficient(weight, sources, p_bar, sample_points, frequency)
+    assert relative_error(c_qr, c_true) < 1e-8
+    assert relative_error(c_qr, c_svd) < 1e-8
+
+def test_rank_deficient_factorization_falls_back(points):
+    # a repeated source makes R singular, the pseudoinverse still fits p_bar
+    sample_points, sources = points
+    frequency = 250.0
+    weight = np.ones(len(sample_points))
+    sources = np.vstack([sources[:2], sources[:1]])
+    V = multipole_basis(sample_points, sources, frequency)
+    p_bar = V[:, :8] @ np.arange(1, 9)
+
+    Q = OrthoBasis(len(sample_points), 12)
+    for j in range(len(sources)):
+        Q.append(V[:, 4 * j:4 * j + 4])
+
+    c = compute_coefficient(weight, sources, p_bar, sample_points, frequency, factorization=Q)
+    assert np.all(np.isfinite(c))
+    assert relative_error(V @ c, p_bar) < 1e-6
+
+@pytest.mark.parametrize("l_max", [0, 2, 4, 6])
+def test_higher_orders_match_scalar_path(points, l_max):
+    sample_points, sources = points
+    frequency = 820.0
+    k = 2 * np.pi * frequency / SPEED_OF_SOUND
+
+    V = multipole_basis(sample_points, sources, frequency, l_max=l_max)
+    assert V.shape == (40, num_terms(l_max) * 5)
+    assert relative_error(V, scalar_basis(sample_points, sources, k, l_max)) < 1e-11
+
+def test_order_from_terms():
+    assert [order_from_terms(num_terms(l_max)) for l_max in range(5)] == list(range(5))
+    with pytest.raises(ValueError):
+        order_from_terms(5)
+
+def test_pressures_infer_order(points):
+    # the order follows from the number of coefficients per source
+    sample_points, sources = points
+    rng = np.random.default_rng(7)
+    ks = [2.0, 9.0]
+    coefficients = [rng.normal(size=9 * 5) + 1j * rng.normal(size=9 * 5) for _ in ks]
+
+    p = multipole_pressures(sample_points, sources, coefficients, ks, chunk_size=17)
+    for j, k in enumerate(ks):
+        expected = multipole_basis_k(sample_points, sources, k, l_max=2) @ coefficients[j]
+        assert relative_error(p[:, j], expected) < 1e-12
+
+def test_ortho_basis_append():
+    # blocks appended past the initial capacity still factor the stacked columns
+    rng = np.random.default_rng(10)
+    blocks = [rng.normal(size=(60, 4)) + 1j * rng.normal(size=(60, 4)) for _ in range(5)]
+    Q = OrthoBasis(60, 8)
+    for block in blocks:
+        new = Q.append(block)
+        assert new.shape == (60, 4)
+    A = np.hstack(blocks)
+    assert Q.size == 20
+    assert np.allclose(Q.Q.conj().T @ Q.Q, np.eye(20), atol=1e-12)
+    assert np.allclose(Q.Q @ Q.R, A)
+    assert np.allclose(np.triu(Q.R), Q.R)
+
+def test_area_sketch_keeps_total_area():
+    weight = np.sqrt(np.random.default_rng(13).uniform(0.1, 2.0, size=1000))
+    rows, sketch_weight = sketch_rows(weight, 200, rng=0)
+    assert np.all(np.diff(rows) > 0)
+    assert np.isclose(np.sum(sketch_weight**2), np.sum(weight**2))
+
+def test_leverage_sketch_is_unbiased():
+    rng = np.random.default_rng(14)
+    weight = np.sqrt(rng.uniform(0.1, 2.0, size=500))
+    A = rng.normal(size=(500, 6))
+    leverage = leverage_scores(A)
+    assert np.isclose(leverage.sum(), 6)
+
+    f = rng.normal(size=500)**2
+    estimates = []
+    for seed in range(400):
+        rows, sketch_weight = sketch_rows(weight, 100, rng=seed, leverage=leverage)
+        estimates.append(np.sum(sketch_weight**2 * f[rows]))
+    assert np.isclose(np.mean(estimates), np.sum(weight**2 * f), rtol=0.02)
+
+def test_weighted_residual(points):
+    sample_points, sources = points
+    weight = np.linspace(0.5, 1.5, len(sample_points))
+    c = np.arange(20) * (1 - 0.5j)
+    p_bar = multipole_basis(sample_points, sources, 300.0) @ c
+    assert weighted_residual(weight, p_bar, sample_points, sources, c, 300.0) < 1e-12
+    assert np.isclose(weighted_residual(weight, 2 * p_bar, sample_points, sources, c, 300.0), 0.5)
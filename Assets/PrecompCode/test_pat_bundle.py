@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from pat_bundle import write_bundle, load_bundle, modes_from_patlist
+from verify import verify_bundle
+
+@pytest.fixture
+def modes():
+    rng = np.random.default_rng(6)
+    shared = 0.05 * rng.normal(size=(5, 3))
+    return [
+        {"frequency": f, "k": 2 * np.pi * f / 343, "positions": shared,
+         "coefficients": rng.normal(size=20) + 1j * rng.normal(size=20)}
+        for f in (120.0, 340.0, 910.0)
+    ]
+
+def write_patlist(directory, modes):
+    # per-mode .sources/.k files as main.export_sound_data writes them, order 1
+    names = []
+    for mode in modes:
+        base = directory / f"{mode['frequency']:.0f}"
+        c = mode["coefficients"].reshape(len(mode["positions"]), -1)
+        rows = np.empty((len(c), 3 + 2 * c.shape[1]))
+        rows[:, :3] = mode["positions"]
+        rows[:, 3::2] = c.real
+        rows[:, 4::2] = c.imag
+        rows.tofile(f"{base}.sources")
+        np.array([mode["k"]]).tofile(f"{base}.k")
+        names.append(base.name)
+    patlist = directory / "PATlist.txt"
+    patlist.write_text("\n".join(names))
+    return patlist
+
+def test_round_trip(tmp_path, modes):
+    filename = tmp_path / "object.pat"
+    write_bundle(filename, modes)
+    loaded = load_bundle(filename)
+    assert len(loaded) == 3
+    for mode, stored in zip(modes, loaded):
+        assert stored["order"] == 1
+        assert np.array_equal(stored["positions"], mode["positions"])
+        assert np.array_equal(stored["coefficients"], mode["coefficients"])
+    # identical positions are stored once
+    assert len({mode["positions"].ctypes.data for mode in loaded}) == 1
+
+def test_patlist_round_trip(tmp_path, modes):
+    loaded = modes_from_patlist(write_patlist(tmp_path, modes))
+    for mode, stored in zip(modes, loaded):
+        assert np.isclose(stored["frequency"], mode["frequency"])
+        assert np.array_equal(stored["coefficients"], mode["coefficients"])
+
+def test_verify_float32_against_reference(tmp_path, modes):
+    filename = tmp_path / "object.pat"
+    patlist = write_patlist(tmp_path, modes)
+    write_bundle(filename, modes, dtype=np.float32)
+    assert verify_bundle(filename, reference=patlist)
+    # the float32 error is measured and compared to the tolerance
+    assert not verify_bundle(filename, reference=patlist, tolerance=1e-9)
+
+def test_verify_detects_storage_loss(tmp_path, modes):
+    # a bundle that lost 1% of its coefficients passes on its own, not against the reference
+    filename = tmp_path / "object.pat"
+    patlist = write_patlist(tmp_path, modes)
+    write_bundle(filename, [dict(mode, coefficients=mode["coefficients"] * 1.01) for mode in modes], dtype=np.float32)
+    assert verify_bundle(filename)
+    assert not verify_bundle(filename, reference=patlist)
@@ -0,0 +1,111 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from evaluate import evaluate_modes, group_modes, load_bundle_modes
+from pat_bundle import write_bundle
+from pat_service import PatService, PatClient
+
+@pytest.fixture
+def bundle(tmp_path):
+    rng = np.random.default_rng(8)
+    shared = 0.05 * rng.normal(size=(4, 3))
+    modes = [
+        {"frequency": f, "k": 2 * np.pi * f / 343, "positions": shared,
+         "coefficients": rng.normal(size=16) + 1j * rng.normal(size=16)}
+        for f in (150.0, 420.0, 990.0)
+    ]
+    modes.append({"frequency": 1300.0, "k": 2 * np.pi * 1300.0 / 343, "positions": 0.05 * rng.normal(size=(3, 3)),
+                  "coefficients": rng.normal(size=12) + 1j * rng.normal(size=12)})
+    filename = tmp_path / "object.pat"
+    write_bundle(filename, modes)
+    return filename
+
+def run_with_client(bundle, session, **options):
+    # serve the bundle on a free local port and run session(service, client)
+    async def main():
+        service = PatService({"object": bundle}, **options)
+        server = await service.start(port=0)
+        client = await PatClient.connect(port=server.sockets[0].getsockname()[1])
+        try:
+            return await session(service, client)
+        finally:
+            await client.close()
+            server.close()
+    return asyncio.run(main())
+
+def test_modes_are_grouped_once(bundle):
+    async def session(service, client):
+        obj = service.objects["object"]
+        assert obj.groups == group_modes(obj.modes) == [[0, 1, 2], [3]]
+    run_with_client(bundle, session)
+
+def test_coalesced_amplitudes(bundle):
+    listeners = [np.random.default_rng(i).normal(size=(5, 3)) for i in range(20)]
+
+    async def session(service, client):
+        amplitudes = await asyncio.gather(*[client.amplitudes("object", l) for l in listeners])
+        return amplitudes, await client.stats()
+    amplitudes, stats = run_with_client(bundle, session, batch_window=0.01)
+
+    # the concurrent requests are evaluated together, far fewer batches than requests
+    assert stats["block_requests"] == 20
+    assert stats["batches"] < 20
+    assert stats["mean_batch_size"] == 20 / stats["batches"]
+    assert stats["listeners"] == 100
+
+    expected = evaluate_modes(np.concatenate(listeners), load_bundle_modes(bundle))
+    result = np.concatenate(amplitudes)
+    assert result.shape == (100, 4)
+    assert np.max(np.abs(result - expected)) / expected.max() < 1e-4
+
+def test_pcm_stream(bundle):
+    async def session(service, client):
+        struck = await client.render("object", "a", [0, 0, 1], impact=1.0)
+        ringing = await client.render("object", "a", [0, 0, 1])
+        silent = await client.render("object", "b", [0, 0, 1])
+        return struck, ringing, silent, service.block_size
+    struck, ringing, silent, block_size = run_with_client(bundle, session)
+
+    assert struck.shape == ringing.shape == (block_size,)
+    assert np.abs(struck).max() > 0 and np.abs(ringing).max() > 0
+    # streams are independent, "b" was never struck
+    assert not silent.any()
+
+def test_error_responses(bundle):
+    async def session(service, client):
+        with pytest.raises(RuntimeError, match="nope"):
+            await client.amplitudes("nope", [0, 0, 1])
+        with pytest.raises(RuntimeError, match="unknown op"):
+            await client.request({"op": "teleport"})
+        # the connection keeps serving after errors
+        amplitudes = await client.amplitudes("object", [0, 0, 1])
+        return amplitudes, await client.stats()
+    amplitudes, stats = run_with_client(bundle, session)
+
+    assert amplitudes.shape == (1, 4)
+    assert stats["errors"] == 2
+    assert stats["block_requests"] == 1
+
+def test_streams_are_dropped(bundle):
+    async def session(service, client):
+        await client.render("object", "a", [0, 0, 1], impact=1.0)
+        await client.render("object", "b", [0, 0, 1], impact=1.0)
+        open_streams = set(service.streams)
+        closed = await client.close_stream("object", "a"), await client.close_stream("object", "a")
+
+        # "b" decays below SILENCE within a few blocks and is dropped
+        blocks = 0
+        while ("object", "b") in service.streams and blocks < 100:
+            await client.render("object", "b", [0, 0, 1])
+            blocks += 1
+        restarted = await client.render("object", "b", [0, 0, 1])
+        return open_streams, closed, blocks, set(service.streams), restarted
+    open_streams, closed, blocks, streams, restarted = run_with_client(bundle, session, damping=200.0)
+
+    assert open_streams == {("object", "a"), ("object", "b")}
+    assert closed == (True, False)
+    assert 0 < blocks < 100
+    assert streams == set()
+    assert not restarted.any()
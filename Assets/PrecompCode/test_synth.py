@@ -0,0 +1,50 @@
+import numpy as np
+
+from synth import ModalSynth
+
+SAMPLE_RATE = 44100
+
+def test_damped_sines():
+    frequencies = np.array([220.0, 1375.0])
+    damping = np.array([3.0, 20.0])
+    gains = np.array([0.3, 0.2])
+    synth = ModalSynth(frequencies, damping=damping, sample_rate=SAMPLE_RATE, block_size=256, gains=gains)
+    synth.strike()
+    signal = np.concatenate(list(synth.blocks(8)))
+
+    t = np.arange(len(signal)) / SAMPLE_RATE
+    expected = gains @ (np.exp(-damping[:, None] * t) * np.sin(2 * np.pi * frequencies[:, None] * t))
+    assert np.allclose(signal, expected, atol=1e-9)
+
+def test_block_size_does_not_change_the_signal():
+    signals = []
+    for block_size in (64, 512):
+        synth = ModalSynth([440.0, 660.0], damping=5.0, block_size=block_size, gains=[0.2, 0.1])
+        synth.strike()
+        signals.append(np.concatenate(list(synth.blocks(2048 // block_size))))
+    assert np.allclose(signals[0], signals[1], atol=1e-9)
+
+def test_strike_offset():
+    synth = ModalSynth([1000.0], block_size=128, gains=[0.5])
+    synth.strike(offset=40)
+    block = synth.process_block()
+    assert not block[:41].any()
+    assert block[41] != 0
+
+def test_limiter():
+    synth = ModalSynth(np.linspace(200, 2000, 16), damping=2.0, block_size=256, gains=np.ones(16))
+    synth.strike()
+    peaks = [np.abs(block).max() for block in synth.blocks(20)]
+    assert max(peaks) <= synth.limiter_threshold + 1e-12
+
+def test_idle():
+    synth = ModalSynth([440.0, 880.0], damping=500.0, sample_rate=SAMPLE_RATE, block_size=256)
+    assert synth.idle(1e-6)
+    synth.strike(1.0)
+    assert not synth.idle(1e-6)
+    blocks = 0
+    while not synth.idle(1e-6):
+        synth.process_block()
+        blocks += 1
+    # |state| = exp(-damping * t) drops below 1e-6 after ln(1e6) / 500 s
+    assert blocks == int(np.ceil(np.log(1e6) / 500.0 * SAMPLE_RATE / 256))
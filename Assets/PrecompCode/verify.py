@@ -1,6 +1,16 @@
+import argparse
 import numpy as np
+import os
 import struct
 
+from evaluate import evaluate_modes
+from multipole_util import lm_pairs
+from pat_bundle import read_header, load_bundle, read_k_file, modes_from_patlist, num_terms, PAYLOAD_DTYPES
+from directivity import validation_error
+
+# max relative pressure error of a bundle evaluated in float32 against the float64 reference
+FLOAT32_TOLERANCE = 1e-4
+
 def verify_sources_file(filename):
     """
     Reads and verifies the structure of a .sources binary file.
@@ -10,6 +20,11 @@ def verify_sources_file(filename):
     """
     print(f"Verifying {filename}...")
 
+    # multipole order from the .k file next to it, order 1 if there is none
+    k_filename = f"{filename[:-len('.sources')]}.k"
+    l_max = read_k_file(k_filename)[1] if os.path.exists(k_filename) else 1
+    width = 3 + 2 * num_terms(l_max)
+
     # Read binary file
     with open(filename, "rb") as f:
         data = f.read()
@@ -17,25 +32,143 @@ def verify_sources_file(filename):
     # Convert binary data to NumPy array (double precision)
     values = np.frombuffer(data, dtype=np.float64)
 
-    # Check if the number of values is a multiple of 11
-    if len(values) % 11 != 0:
-        print(f"❌ ERROR: Data length {len(values)} is not a multiple of 11!")
+    # Check if the number of values is a multiple of the source width
+    if len(values) % width != 0:
+        print(f"❌ ERROR: Data length {len(values)} is not a multiple of {width}!")
         return
 
-    num_sources = len(values) // 11
-    print(f"✅ {num_sources} sources found in {filename}.")
+    num_sources = len(values) // width
+    print(f"✅ {num_sources} sources of order {l_max} found in {filename}.")
 
     # Print first 5 sources for verification
     for i in range(min(num_sources, 5)):  # Show up to 5 sources
-        source_data = values[i * 11 : (i + 1) * 11]
+        source_data = values[i * width : (i + 1) * width]
         print(f"\n🔹 Source {i + 1}:")
         print(f"  Position:     ({source_data[0]:.6f}, {source_data[1]:.6f}, {source_data[2]:.6f})")
-        print(f"  Monopole:     ({source_data[3]:.6f} + {source_data[4]:.6f}j)")
-        print(f"  Dipole (m=0): ({source_data[5]:.6f} + {source_data[6]:.6f}j)")
-        print(f"  Dipole (m=-1): ({source_data[7]:.6f} + {source_data[8]:.6f}j)")
-        print(f"  Dipole (m=+1): ({source_data[9]:.6f} + {source_data[10]:.6f}j)")
+        for j, (l, m) in enumerate(lm_pairs(l_max)):
+            print(f"  (l={l}, m={m:+d}): ({source_data[3 + 2 * j]:.6f} + {source_data[4 + 2 * j]:.6f}j)")
 
     print(f"\n✅ Verification complete! File format appears correct.")
 
-# Example usage
-verify_sources_file("output/101.sources")
+def fibonacci_sphere(n):
+    # n roughly uniform unit directions
+    i = np.arange(n) + 0.5
+    z = 1 - 2 * i / n
+    phi = np.pi * (1 + 5**0.5) * i
+    rho = np.sqrt(1 - z**2)
+    return np.column_stack((rho * np.cos(phi), rho * np.sin(phi), z))
+
+def verify_bundle(filename, num_listeners=256, listener_distance=1.0, reference=None, tolerance=FLOAT32_TOLERANCE):
+    """
+    Reads and verifies the structure of a PAT bundle and reports the
+    accuracy lost by storing and evaluating it in float32.
+    
+    Args:
+        filename (str): Path to the bundle file.
+        num_listeners (int): Number of listener directions for the float32 check.
+        listener_distance (float): Distance of the listeners from the source centroid.
+        reference (str): PATlist file of the float64 modes the bundle was packed from.
+            Without it the stored data is the reference, so the loss of float32
+            storage cannot be seen, only that of float32 arithmetic.
+        tolerance (float): Max relative pressure error of the float32 check.
+    """
+    print(f"Verifying {filename}...")
+    
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    try:
+        header, table = read_header(data)
+    except ValueError as e:
+        print(f"❌ ERROR: {e}")
+        return False
+    
+    if int(header["dtype"]) not in PAYLOAD_DTYPES:
+        print(f"❌ ERROR: unknown payload dtype code {header['dtype']}!")
+        return False
+    position_dtype, coefficient_dtype = PAYLOAD_DTYPES[int(header["dtype"])]
+    alignment = int(header["alignment"])
+    print(f"✅ version {header['version']}, {header['mode_count']} modes, {position_dtype.name} payload.")
+    num_position_blocks = len(np.unique(table["positions_offset"]))
+    if num_position_blocks < len(table):
+        print(f"✅ {len(table)} modes share {num_position_blocks} position blocks.")
+    
+    # every block has to be aligned and inside the file
+    for i, entry in enumerate(table):
+        source_count = int(entry["source_count"])
+        blocks = [
+            (int(entry["positions_offset"]), source_count * 3 * position_dtype.itemsize),
+            (int(entry["coefficients_offset"]), source_count * num_terms(int(entry["order"])) * coefficient_dtype.itemsize),
+        ]
+        if int(entry["directivity_offset"]) != 0:
+            num_radii = int(entry["directivity_radii"])
+            blocks.append((
+                int(entry["directivity_offset"]),
+                8 * (3 + num_radii) + 4 * num_radii * int(entry["directivity_theta"]) * int(entry["directivity_phi"])
+            ))
+        for offset, size in blocks:
+            if offset % alignment != 0 or offset + size > len(data):
+                print(f"❌ ERROR: mode {i} has a block at {offset} of {size} bytes, file is {len(data)} bytes!")
+                return False
+    
+    modes = load_bundle(filename)
+    for mode in modes:
+        if not (np.isfinite(mode["positions"]).all() and np.isfinite(mode["coefficients"]).all()):
+            print(f"❌ ERROR: mode {mode['frequency']:.3f} Hz has non-finite values!")
+            return False
+    
+    if reference is not None:
+        reference_modes = modes_from_patlist(reference)
+        if len(reference_modes) != len(modes) or not all(
+            np.isclose(ref["k"], mode["k"]) and ref["order"] == mode["order"] for ref, mode in zip(reference_modes, modes)
+        ):
+            print(f"❌ ERROR: {reference} does not hold the modes of the bundle!")
+            return False
+    else:
+        reference_modes = [
+            {"positions": np.asarray(mode["positions"], dtype=np.float64), "coefficients": np.asarray(mode["coefficients"], dtype=np.complex128)}
+            for mode in modes
+        ]
+        if position_dtype == np.float32:
+            print(f"⚠️  float32 bundle without a float64 reference, only the float32 arithmetic is checked.")
+    
+    # pressure around the object, float64 reference against float32 data and arithmetic
+    print(f"\n🔹 float32 accuracy at {listener_distance} m, tolerance {tolerance:.0e}:")
+    accurate = True
+    for mode, ref in zip(modes, reference_modes):
+        positions = np.asarray(mode["positions"])
+        coefficients = np.asarray(mode["coefficients"])
+        listeners = ref["positions"].mean(axis=0) + listener_distance * fibonacci_sphere(num_listeners)
+        
+        p_ref = evaluate_modes(listeners, [(ref["positions"], ref["coefficients"], mode["k"])])
+        p_32 = evaluate_modes(listeners, [(positions.astype(np.float32), coefficients.astype(np.complex64), mode["k"])], dtype=np.float32)
+        error = np.max(np.abs(p_32 - p_ref)) / np.max(np.abs(p_ref))
+        accurate &= error <= tolerance
+        print(f"  {'✅' if error <= tolerance else '❌'} {mode['frequency']:9.3f} Hz, {len(positions)} sources, order {mode['order']}: max relative error {error:.2e}")
+    
+    # baked tables against the exact evaluator
+    tables = [mode for mode in modes if mode["directivity"] is not None]
+    if tables:
+        print(f"\n🔹 Directivity tables:")
+    for mode in tables:
+        table = mode["directivity"]
+        error = validation_error(table, np.asarray(mode["positions"]), np.asarray(mode["coefficients"]), mode["k"])
+        print(f"  {mode['frequency']:9.3f} Hz, {table['magnitudes'].shape} grid: stored error {table['max_error']:.2e}, measured {error:.2e}")
+    
+    if not accurate:
+        print(f"\n❌ ERROR: float32 error above {tolerance:.0e}!")
+        return False
+    print(f"\n✅ Verification complete! Bundle format appears correct.")
+    return True
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Verify .sources files and PAT bundles")
+    parser.add_argument("filenames", nargs="*", default=["output/101.sources"])
+    parser.add_argument("--reference", default=None, help="PATlist file of the float64 modes a bundle was packed from")
+    parser.add_argument("--tolerance", type=float, default=FLOAT32_TOLERANCE, help="max relative float32 pressure error")
+    args = parser.parse_args()
+    
+    # Example usage
+    for filename in args.filenames:
+        if filename.endswith(".pat"):
+            verify_bundle(filename, reference=args.reference, tolerance=args.tolerance)
+        else:
+            verify_sources_file(filename)